@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""Cost of binding a per-request handler copy versus reusing one instance.
+
+    python benchmarks/handler_bench.py
+"""
+import collections
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from nacho.app import Application
+
+
+# the fields of tulip.http.RawRequestMessage a Request reads
+Message = collections.namedtuple('Message', 'method path version headers')
+
+
+class Context(object):
+    __slots__ = ('handler', 'server', 'request', 'payload', 'prev_response')
+
+    def __init__(self, handler, server, message, payload, prev_response=None):
+        self.handler = handler
+        self.server = server
+        self.request = message
+        self.payload = payload
+        self.prev_response = prev_response
+
+
+def main():
+    handler = Application()
+    message = Message('GET', '/', (1, 1), {})
+    number = 1000000
+    cases = [
+        ('shared instance', lambda: handler.initialize(1, message, 3)),
+        ('__slots__ context', lambda: Context(handler, 1, message, 3)),
+        ('per-request copy', lambda: handler.for_request(1, message, 3)),
+    ]
+    for name, case in cases:
+        best = min(timeit.repeat(case, number=number, repeat=3))
+        print('{:<20} {:>8.0f}ns'.format(name, best / number * 1e9))
+
+
+if __name__ == '__main__':
+    main()
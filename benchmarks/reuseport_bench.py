@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Per-worker connection distribution: shared listen socket vs SO_REUSEPORT.
+
+Forks workers that accept on non-blocking sockets from a select() loop,
+like the tulip event loop in each nacho worker, and reports how many
+connections each one served and how many wakeups found nothing to accept.
+
+    python benchmarks/reuseport_bench.py [workers] [connections]
+"""
+import concurrent.futures
+import os
+import select
+import signal
+import socket
+import sys
+import time
+
+HOST = '127.0.0.1'
+
+
+def bind(port, reuseport):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((HOST, port))
+    sock.listen(1024)
+    sock.setblocking(False)
+    return sock
+
+
+def serve(sock):
+    spurious = 0
+    while True:
+        select.select([sock], [], [])
+        try:
+            conn, _ = sock.accept()
+        except (BlockingIOError, InterruptedError):
+            spurious += 1
+            continue
+        conn.setblocking(True)
+        conn.recv(64)
+        deadline = time.perf_counter() + 0.0002  # a little request work
+        while time.perf_counter() < deadline:
+            pass
+        conn.sendall('{} {}'.format(os.getpid(), spurious).encode('ascii'))
+        conn.close()
+
+
+def request(port):
+    conn = socket.create_connection((HOST, port))
+    try:
+        conn.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        return conn.recv(64).decode('ascii')
+    finally:
+        conn.close()
+
+
+def run(reuseport, workers, connections):
+    probe = socket.socket()
+    probe.bind((HOST, 0))
+    port = probe.getsockname()[1]
+    probe.close()
+
+    shared = None if reuseport else bind(port, False)
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if not pid:
+            try:
+                serve(shared or bind(port, True))
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    time.sleep(0.3)
+
+    served, spurious = {}, {}
+    try:
+        with concurrent.futures.ThreadPoolExecutor(32) as pool:
+            for reply in pool.map(request, [port] * connections):
+                pid, wakeups = reply.split()
+                served[pid] = served.get(pid, 0) + 1
+                spurious[pid] = max(spurious.get(pid, 0), int(wakeups))
+    finally:
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        if shared is not None:
+            shared.close()
+
+    counts = sorted((served.get(str(pid), 0) for pid in pids), reverse=True)
+    print('{:<10} served per worker: {}'.format(
+        'reuseport' if reuseport else 'shared', counts))
+    print('{:<10} max/min: {:.2f}  empty wakeups: {}'.format(
+        '', counts[0] / max(counts[-1], 1), sum(spurious.values())))
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    connections = int(sys.argv[2]) if len(sys.argv) > 2 else 4000
+    run(False, workers, connections)
+    if hasattr(socket, 'SO_REUSEPORT'):
+        run(True, workers, connections)
+    else:
+        print('SO_REUSEPORT is not available on this platform')
+
+
+if __name__ == '__main__':
+    main()
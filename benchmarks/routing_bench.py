@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Compare Router.get_handler against the old linear regex scan.
+
+    python benchmarks/routing_bench.py
+"""
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from nacho.routing import Router
+
+
+class LinearRouter(object):
+
+    def __init__(self):
+        self.handlers = []
+
+    def add_handler(self, url_regex, handlers):
+        self.handlers.append((re.compile(url_regex), [handlers]))
+
+    def get_handler(self, url):
+        for matcher, handler in self.handlers:
+            match = matcher.match(url)
+            if match:
+                return handler, match.groups()
+        return None, None
+
+
+def build(router, count):
+    for idx in range(count):
+        if idx % 2:
+            router.add_handler('/static{}/'.format(idx), [idx])
+        else:
+            router.add_handler(r'/api/v{}/(\w+)/(\d+)$'.format(idx), [idx])
+    router.add_handler('/(.*)', ['home'])
+    return router
+
+
+def urls(count):
+    # worst case (last routes and the catch-all) plus a spread of hits
+    paths = ['/api/v{}/users/42'.format(count - 2),
+             '/static{}/app.js'.format(count - 1),
+             '/not/routed']
+    paths.extend('/api/v{}/items/{}'.format(idx, idx)
+                 for idx in range(0, count, max(count // 10, 2)))
+    return paths
+
+
+def bench(router, paths, number):
+    def run():
+        for path in paths:
+            router.get_handler(path)
+    return min(timeit.repeat(run, number=number, repeat=3)) / \
+        (number * len(paths))
+
+
+def main():
+    print('{:>6} {:>12} {:>12} {:>12} {:>8}'.format(
+        'routes', 'linear', 'compiled', 'cached', 'speedup'))
+    for count in (10, 100, 1000):
+        paths = urls(count)
+        number = 20000 // count or 1
+        linear = build(LinearRouter(), count)
+        compiled = build(Router(cache_size=0), count)
+        cached = build(Router(), count)
+        t_linear = bench(linear, paths, number)
+        t_compiled = bench(compiled, paths, number)
+        t_cached = bench(cached, paths, number)
+        print('{:>6} {:>10.2f}us {:>10.2f}us {:>10.2f}us {:>7.1f}x'.format(
+            count, t_linear * 1e6, t_compiled * 1e6, t_cached * 1e6,
+            t_linear / t_cached))
+
+
+if __name__ == '__main__':
+    main()
@@ -21,10 +21,12 @@ def urls():
     router.add_handler('/static/',
                        StaticFile('/Users/avelino/projects/nacho/example/'))
     router.add_handler('/(.*)', Home())
-    return HttpServer(router, debug=True, keep_alive=75)
+    return router
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
+    # one router (and handler instances) shared by every connection
+    router = urls()
     superviser = Superviser()
-    superviser.start(urls)
\ No newline at end of file
+    superviser.start(lambda: HttpServer(router, debug=True, keep_alive=75))
\ No newline at end of file
@@ -1,125 +1,604 @@
 #!/usr/bin/env python3
-import cgi
+import functools
+import json
+import mimetypes
 import os
+import time
+from urllib.parse import unquote
+
 import tulip
 import tulip.http
-import email.message
-from urllib.parse import urlparse
 from tulip.http.errors import HttpErrorException
 
+from nacho import cache, compression, executor, static
+from nacho.request import Request
 from nacho.renderers.quik import QuikWorker
 
 
 class Application(object):
 
     template_dirs = ['html']
+    template_cache_size = 256
+    template_auto_reload = False
+    stream_templates = False
+    stream_chunk_size = 8192
+    content_type = 'text/html'
+    # chunked output is coalesced into chunks of this many bytes, None
+    # sizes them to the socket send buffer
+    chunk_size = None
+    # bodies smaller than this are sent uncompressed, with a Content-Length
+    compress_min_size = 1024
+    compress_level = 6
+    compress_types = compression.COMPRESSIBLE_TYPES
+    # render templates on the thread pool instead of the event loop
+    render_in_executor = False
+    # cache GET and HEAD responses for this many seconds, see cache.cached
+    cache_ttl = 0
+    cache_stale = 0
+    cache_vary = ()
+    response_cache = cache.ResponseCache()
+    # wraps each request message, set its max_* attributes to cap parsing
+    request_class = Request
+    # serializes self.json() bodies to str or bytes, e.g. ujson.dumps
+    json_dumps = staticmethod(functools.partial(json.dumps,
+                                                separators=(',', ':')))
     http_method_names = ['get', 'post', 'put', 'delete', 'head', 'options', 'trace']
 
+    _response = None
+    _deferred = False
+
     def __init__(self, write_headers=True):
         self.response = None
         self.write_headers = write_headers
-        self.renderer = QuikWorker(self.template_dirs)
+        self.renderer = QuikWorker(self.template_dirs,
+                                   cache_size=self.template_cache_size,
+                                   auto_reload=self.template_auto_reload)
+
+    def for_request(self, server, message, payload, prev_response=None):
+        """Return a copy of this handler bound to one request.
+
+        Routes keep a single configured instance, each request runs on its
+        own copy so concurrent requests never share request state.
+        """
+        handler = object.__new__(self.__class__)
+        handler.__dict__.update(self.__dict__)
+        handler.initialize(server, message, payload, prev_response)
+        return handler
 
     def initialize(self, server, message, payload, prev_response=None):
         self.server = server
+        if not isinstance(message, Request):
+            message = self.request_class(message, payload)
         self.request = message
         self.payload = payload
         self.prev_response = prev_response
-        if self.write_headers:
-            self.response = self._write_headers()
+        self._pending = []
+        # built on first use, so json() can pick another kind of response
+        self._response = None
+        self._deferred = self.write_headers
+
+    @property
+    def response(self):
+        if self._deferred:
+            self._deferred = False
+            self._response = self._write_headers()
+        return self._response
+
+    @response.setter
+    def response(self, response):
+        self._deferred = False
+        self._response = response
 
     def __call__(self, request_args=None):
         if self.request.method.lower() in self.http_method_names:
             handler = getattr(self, self.request.method.lower(), None)
             if handler:
-                return handler()
+                # reject an announced oversized body before reading any
+                self.request.check_length()
+                ttl = getattr(handler, 'cache_ttl', self.cache_ttl)
+                if ttl and self.write_headers and \
+                        self.request.method in ('GET', 'HEAD'):
+                    return self._cached(handler, ttl)
+                return self._dispatch(handler)
         self.response.write(b'nacho: base handler')
         return self.response
 
+    def _dispatch(self, handler):
+        if getattr(handler, 'blocking', False):
+            result = self._run_blocking(handler)
+        else:
+            result = handler()
+        if self._pending or tulip.iscoroutine(result) or \
+                isinstance(result, tulip.Future):
+            return self._wait(result)
+        return result
+
+    def cache_key(self, vary=(), name=None):
+        """Cache key of this request for the handler method ``name``.
+
+        Handler class and method (every Application shares
+        ``response_cache``), request method, Host, path, normalized query,
+        negotiated encoding and ``vary`` headers.
+        """
+        path = self.request.path.split('?', 1)[0]
+        query = tuple(sorted(
+            (key, tuple(value) if isinstance(value, list) else value)
+            for key, value in self.query.items()))
+        handler = '{}.{}.{}'.format(type(self).__module__,
+                                    type(self).__qualname__, name)
+        return (handler, self.request.method, self.get_header('Host'), path,
+                query,
+                compression.negotiate(self.get_header('Accept-Encoding')),
+                tuple(self.get_header(name) for name in vary))
+
+    @tulip.coroutine
+    def _cached(self, handler, ttl):
+        stale = getattr(handler, 'cache_stale', self.cache_stale)
+        key = self.cache_key(getattr(handler, 'cache_vary', self.cache_vary),
+                             handler.__name__)
+        encoding = compression.negotiate(self.get_header('Accept-Encoding'))
+        render = functools.partial(self._render_cached, handler.__name__,
+                                   encoding)
+        entry = self.response_cache.get(key)
+        now = time.monotonic()
+        if entry is None or entry.stale_until <= now:
+            entry = yield from self.response_cache.fill(key, render, ttl, stale)
+        elif entry.expires <= now:
+            self.response_cache.revalidate(key, render, ttl, stale)
+        if entry is None:
+            # rendered for another request and not shareable, see
+            # CachedResponse.cacheable
+            result = self._dispatch(handler)
+            if tulip.iscoroutine(result) or isinstance(result, tulip.Future):
+                yield from result
+            return
+        self._send_cached(entry)
+
+    @tulip.coroutine
+    def _render_cached(self, name, encoding):
+        handler = self.for_request(self.server, self.request, self.payload,
+                                   self.prev_response)
+        handler.response = buf = cache.BufferedResponse(self.content_type)
+        result = handler._dispatch(getattr(handler, name))
+        if tulip.iscoroutine(result) or isinstance(result, tulip.Future):
+            yield from result
+
+        body = b''.join(buf.chunks)
+        headers = [('Content-type', buf.content_type)] \
+            if buf.content_type else []
+        headers.extend(buf.headers)
+        if compression.is_compressible(buf.content_type, self.compress_types):
+            # the entry is one of the encodings of this url
+            headers.append(('Vary', 'Accept-Encoding'))
+            if encoding and len(body) >= self.compress_min_size:
+                body = compression.compress(body, encoding,
+                                            self.compress_level)
+                headers.append(('Content-Encoding', encoding))
+        return cache.CachedResponse(buf.status, headers, body)
+
+    def _send_cached(self, entry):
+        response = tulip.http.Response(self.server.transport, entry.status,
+                                       close=self.server.closing)
+        response.add_headers(*entry.headers)
+        response.add_header('Content-Length', str(len(entry.body)))
+        response.send_headers()
+        if self.request.method != 'HEAD':
+            response.write(entry.body)
+        self.response = response
+
+    @tulip.coroutine
+    def _wait(self, result):
+        if tulip.iscoroutine(result) or isinstance(result, tulip.Future):
+            result = yield from result
+        # offloaded renders started by the handler
+        while self._pending:
+            yield from self._pending.pop(0)
+        if isinstance(self._response, _OrderedWrites):
+            self.response = self._response.response
+        return result
+
+    @tulip.coroutine
+    def _run_blocking(self, handler):
+        response = self.response
+        if response is not None:
+            self.response = executor.LoopResponse(
+                tulip.get_event_loop(), response)
+        try:
+            result = yield from executor.threads.run(
+                handler, timeout=handler.blocking_timeout)
+        except Exception:
+            if response is not None:
+                # the thread may still be running, drop its late writes
+                self.response.detached = True
+            raise
+        if response is not None:
+            # json() may have replaced the response the thread wrote to
+            self.response = self.response.response
+        return result
+
+    @tulip.coroutine
+    def run_blocking(self, func, *args, process=False, timeout=None):
+        """Run ``func(*args)`` on the worker thread pool (or process pool).
+
+        With the process pool disabled (``--processes 0``) the call runs on
+        the thread pool.
+        """
+        pool = executor.threads
+        if process and executor.processes.max_workers:
+            pool = executor.processes
+        return (yield from pool.run(func, *args, timeout=timeout))
+
+    def get_header(self, name, default=None):
+        return self.request.headers.get(name, default)
+
     @property
     def query(self):
-        parsed = urlparse(self.request.path)
-        querydict = cgi.parse_qs(parsed.query)
-        for key, value in querydict.items():
-            if isinstance(value, list) and len(value) < 2:
-                querydict[key] = value[0] if value else None
-        return querydict
-
-    def _write_headers(self):
-        headers = email.message.Message()
-        response = tulip.http.Response(
-            self.server.transport, 200, close=True)
-        response.add_header('Transfer-Encoding', 'chunked')
-
-        # content encoding
-        accept_encoding = headers.get('accept-encoding', '').lower()
-        if 'deflate' in accept_encoding:
-            response.add_header('Content-Encoding', 'deflate')
-            response.add_compression_filter('deflate')
-        elif 'gzip' in accept_encoding:
-            response.add_header('Content-Encoding', 'gzip')
-            response.add_compression_filter('gzip')
+        return self.request.query
+
+    @property
+    def cookies(self):
+        return self.request.cookies
 
-        response.add_chunking_filter(1025)
+    def _write_headers(self, status=200, content_type=None):
+        encoding = compression.negotiate(self.get_header('Accept-Encoding'))
+        return self.server.response(
+            status, self.request,
+            content_type=content_type or self.content_type, encoding=encoding,
+            min_size=self.compress_min_size, level=self.compress_level,
+            compress_types=self.compress_types, chunk_size=self.chunk_size)
 
-        response.add_header('Content-type', 'text/html')
-        response.send_headers()
+    def json(self, obj, status=200):
+        """Respond with ``obj`` serialized by ``json_dumps``.
+
+        The body is serialized once and sent with its headers and a
+        Content-Length in a single write, replacing any response not
+        started yet. Raises RuntimeError once something was written.
+        """
+        response = self._response
+        if response is not None and response.started:
+            raise RuntimeError('json() on a response already started')
+        body = self.json_dumps(obj)
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if isinstance(response, cache.BufferedResponse):
+            response.status = status
+            response.content_type = 'application/json'
+            response.write(body)
+            return response
+        if isinstance(response, executor.LoopResponse):
+            # blocking handler, the loop builds and sends the response
+            response.replace(self._json_response, status, body)
+            return response
+        self.response = response = self._json_response(status, body)
+        return response
+
+    def _json_response(self, status, body):
+        response = self._write_headers(status, 'application/json')
+        response.send(body)
         return response
 
     def render(self, template_name, **kwargs):
-        self.response.write(self.renderer.render(template_name, **kwargs))
+        if self.render_in_executor and \
+                not isinstance(self.response, executor.LoopResponse):
+            task = tulip.Task(self._render_offloaded(template_name, kwargs))
+            self._pending.append(task)
+            if not isinstance(self.response, _OrderedWrites):
+                self.response = _OrderedWrites(self.response)
+            self.response.append(task)
+            return task
+        if self.stream_templates:
+            writer = _FragmentWriter(self.response, self.stream_chunk_size)
+            self.renderer.stream(template_name, writer.write, **kwargs)
+            writer.flush()
+        else:
+            self.response.write(self.renderer.render(template_name, **kwargs))
+
+    @tulip.coroutine
+    def _render_offloaded(self, template_name, kwargs):
+        render = self.renderer.prepare(template_name)
+        return (yield from executor.threads.run(lambda: render(**kwargs)))
+
+
+class _OrderedWrites(object):
+    """Response proxy writing offloaded renders in the order they were called.
+
+    Renders finish in any order; a render, or a write made after it, waits
+    for the renders called before it.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.queue = []
+
+    @property
+    def started(self):
+        return bool(self.queue) or self.response.started
+
+    def append(self, task):
+        self.queue.append(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        while self.queue:
+            item = self.queue[0]
+            if isinstance(item, tulip.Future):
+                if not item.done():
+                    return
+                if item.cancelled() or item.exception() is not None:
+                    # the request fails, nothing after the render goes out
+                    del self.queue[:]
+                    return
+                item = item.result()
+            del self.queue[0]
+            self.response.write(item)
+
+    def write(self, data):
+        if self.queue:
+            self.queue.append(data)
+        else:
+            self.response.write(data)
+
+    def flush(self):
+        if not self.queue:
+            self.response.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+
+class _FragmentWriter(object):
+    """Coalesce small rendered fragments into ``size`` byte writes.
+
+    Each write is flushed, so it reaches the client while the rest of the
+    template renders instead of waiting for a full response chunk.
+    """
+
+    def __init__(self, response, size):
+        self.response = response
+        self.size = size
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            data = b''.join(self._buffer)
+            self._buffer = []
+            self._buffered = 0
+            self.response.write(data)
+            self.response.flush()
+
+
+# content type of a file mimetypes guesses an encoding for
+_ENCODED_TYPES = {
+    'gzip': 'application/gzip',
+    'bzip2': 'application/x-bzip2',
+    'xz': 'application/x-xz',
+    'compress': 'application/x-compress',
+}
 
 
 class StaticFile(Application):
-    def __init__(self, staticroot):
+
+    # files above this are only served gzipped from a precompressed sibling
+    compress_max_size = 1024 * 1024
+
+    def __init__(self, staticroot, file_cache=None, compressed_cache=None):
         super(StaticFile, self).__init__(write_headers=False)
         self.staticroot = staticroot
+        self.file_cache = file_cache or static.file_cache
+        self.compressed_cache = compressed_cache or static.compressed_cache
+
+    def resolve(self, request_args=None):
+        """Map the matched url group onto a path under ``staticroot``."""
+        name = request_args[-1] if request_args else None
+        if name:
+            name = unquote(name.partition('?')[0].partition('#')[0])
+        if not name:
+            return self.staticroot
+        if '\x00' in name:
+            return None
+        root = os.path.abspath(self.staticroot)
+        path = os.path.abspath(os.path.join(root, name))
+        if path != root and not path.startswith(root + os.sep):
+            return None
+        return path
+
+    @tulip.coroutine
+    def _open(self, loop, path):
+        """Return the cached OpenFile for ``path``, None if not a file."""
+        entry = self.file_cache.get(path)
+        if entry is None and not self.file_cache.is_missing(path):
+            try:
+                entry = yield from loop.run_in_executor(
+                    None, static.open_file, path)
+            except OSError:
+                self.file_cache.add_missing(path)
+            else:
+                self.file_cache.add(entry)
+        return entry
 
+    @tulip.coroutine
     def __call__(self, request_args=None):
-        path = self.staticroot
-        if not os.path.exists(path):
-            print('no file', repr(path))
-            path = None
-        else:
-            isdir = os.path.isdir(path)
+        loop = tulip.get_event_loop()
+        path = self.resolve(request_args)
+        entry = None
+        if path:
+            entry = yield from self._open(loop, path)
+
+        if entry is not None:
+            self.response = yield from self._send_file(loop, path, entry)
+            return self.response
 
-        if not path:
+        isdir = False
+        if path:
+            isdir = yield from loop.run_in_executor(None, os.path.isdir, path)
+        if not isdir:
             raise HttpErrorException(404, message="Path not found")
 
-        headers = email.message.Message()
+        self.response = yield from self._list_directory(loop, path)
+        return self.response
+
+    @tulip.coroutine
+    def _gzip_variant(self, loop, path, entry, compressible):
+        """Return a precompressed ``.gz`` sibling, cached gzip bytes or None."""
+        sibling = yield from self._open(loop, path + '.gz')
+        if sibling is not None and sibling.mtime >= entry.mtime:
+            return sibling
+        if not compressible or entry.size > self.compress_max_size:
+            return None
+        return (yield from self.compressed_cache.get(loop, entry))
+
+    def _file_response(self, status, entry, etag, vary=False):
         response = tulip.http.Response(
-            self.server.transport, 200, close=True)
-        response.add_header('Transfer-Encoding', 'chunked')
+            self.server.transport, status, close=self.server.closing)
+        response.add_header('Accept-Ranges', 'bytes')
+        response.add_header('ETag', etag)
+        response.add_header('Last-Modified', entry.last_modified)
+        if vary:
+            response.add_header('Vary', 'Accept-Encoding')
+        return response
+
+    @tulip.coroutine
+    def _send_file(self, loop, path, entry):
+        content_type, encoding = mimetypes.guess_type(path)
+        if encoding is not None:
+            # e.g. app.js.gz asked for by name: the archive, not the script
+            content_type = _ENCODED_TYPES.get(
+                encoding, 'application/octet-stream')
+        content_type = content_type or 'text/plain'
+        method = self.request.method.upper()
+        compressible = compression.is_compressible(content_type)
+        range_header = self.get_header('Range') if method == 'GET' else None
+
+        body, etag = entry, entry.etag
+        if method in ('GET', 'HEAD') and range_header is None and \
+                compression.accepts_encoding(
+                    self.get_header('Accept-Encoding'), 'gzip'):
+            variant = yield from self._gzip_variant(
+                loop, path, entry, compressible)
+            if variant is not None:
+                body, etag = variant, entry.etag[:-1] + '-gzip"'
+        vary = compressible or body is not entry
 
-        if isdir:
-            response.add_header('Content-type', 'text/html')
+        if method in ('GET', 'HEAD') and static.not_modified(
+                etag, entry.mtime, self.get_header('If-None-Match'),
+                self.get_header('If-Modified-Since')):
+            response = self._file_response(304, entry, etag, vary)
             response.send_headers()
+            return response
 
-            response.write(b'<ul>\r\n')
-            for name in sorted(os.listdir(path)):
-                if name.isprintable() and not name.startswith('.'):
-                    try:
-                        bname = name.encode('ascii')
-                    except UnicodeError:
-                        pass
-                    else:
-                        if os.path.isdir(os.path.join(path, name)):
-                            response.write(b'<li><a href="' + bname +
-                                           b'/">' + bname + b'/</a></li>\r\n')
-                        else:
-                            response.write(b'<li><a href="' + bname +
-                                           b'">' + bname + b'</a></li>\r\n')
-            response.write(b'</ul>')
+        if body is not entry:
+            response = self._file_response(200, entry, etag, vary)
+            response.add_header('Content-type', content_type)
+            response.add_header('Content-Encoding', 'gzip')
+            if isinstance(body, bytes):
+                response.add_header('Content-Length', str(len(body)))
+                response.send_headers()
+                if method != 'HEAD':
+                    response.write(body)
+                return response
+            # precompressed sibling, sent like any other file
+            entry = body
+            ranges = [(0, entry.size - 1)]
+            multipart = None
+            response.add_header('Content-Length', str(entry.size))
         else:
-            response.add_header('Content-type', 'text/plain')
-            response.send_headers()
+            ranges = None
+            if range_header and static.if_range_matches(
+                    entry, self.get_header('If-Range')):
+                ranges = static.parse_range(range_header, entry.size)
 
-            try:
-                with open(path, 'rb') as fp:
-                    chunk = fp.read(8196)
-                    while chunk:
-                        response.write(chunk)
-                        chunk = fp.read(8196)
-            except OSError:
-                response.write(b'Cannot open')
+            if ranges == []:
+                response = tulip.http.Response(
+                    self.server.transport, 416, close=self.server.closing)
+                response.add_header(
+                    'Content-Range', 'bytes */{}'.format(entry.size))
+                response.add_header('Content-Length', '0')
+                response.send_headers()
+                return response
+
+            multipart = None
+            if ranges and len(ranges) > 1:
+                multipart = static.MultipartRanges(
+                    ranges, entry.size, content_type)
+                response = self._file_response(206, entry, etag, vary)
+                response.add_header('Content-type', multipart.content_type)
+                response.add_header('Content-Length', str(multipart.length))
+            elif ranges:
+                start, end = ranges[0]
+                response = self._file_response(206, entry, etag, vary)
+                response.add_header('Content-type', content_type)
+                response.add_header('Content-Range', static.content_range(
+                    start, end, entry.size))
+                response.add_header('Content-Length', str(end - start + 1))
+            else:
+                ranges = [(0, entry.size - 1)]
+                response = self._file_response(200, entry, etag, vary)
+                response.add_header('Content-type', content_type)
+                response.add_header('Content-Length', str(entry.size))
+        response.send_headers()
+        if method == 'HEAD' or not entry.size:
+            return response
+
+        entry.acquire()
+        try:
+            if multipart is not None:
+                # rare enough to always copy through the response
+                for head, start, end in multipart.parts:
+                    response.write(head)
+                    yield from static.read_into(
+                        loop, response, entry.fd, start, end - start + 1)
+                response.write(multipart.tail)
+                return response
+
+            start, end = ranges[0]
+            sock = static.sendfile_socket(self.server.transport)
+            if sock is not None:
+                yield from static.sendfile(
+                    loop, sock, entry.fd, start, end - start + 1)
+            else:
+                # SSL or buffered transport, copy through the response
+                yield from static.read_into(
+                    loop, response, entry.fd, start, end - start + 1)
+        finally:
+            entry.release()
+        return response
+
+    @tulip.coroutine
+    def _list_directory(self, loop, path):
+        names = yield from loop.run_in_executor(None, os.listdir, path)
+        dirs = yield from loop.run_in_executor(None, lambda: set(
+            name for name in names
+            if os.path.isdir(os.path.join(path, name))))
+
+        lines = [b'<ul>\r\n']
+        for name in sorted(names):
+            if name.isprintable() and not name.startswith('.'):
+                try:
+                    bname = name.encode('ascii')
+                except UnicodeError:
+                    pass
+                else:
+                    if name in dirs:
+                        lines.append(b'<li><a href="' + bname +
+                                     b'/">' + bname + b'/</a></li>\r\n')
+                    else:
+                        lines.append(b'<li><a href="' + bname +
+                                     b'">' + bname + b'</a></li>\r\n')
+        lines.append(b'</ul>')
+        body = b''.join(lines)
+
+        response = tulip.http.Response(
+            self.server.transport, 200, close=self.server.closing)
+        response.add_header('Content-type', 'text/html')
+        response.add_header('Content-Length', str(len(body)))
+        response.send_headers()
+        if self.request.method.upper() != 'HEAD':
+            response.write(body)
         return response
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+import collections
+import functools
+import logging
+import pickle
+import time
+
+import tulip
+
+from nacho import shm
+
+
+class LRUCache(object):
+    """Size-bounded mapping that evicts the least recently used key.
+
+    ``maxsize`` bounds the number of entries, or the total returned by
+    ``weigh(value)`` when a weigh function is given (e.g. ``len`` to bound
+    the cache in bytes).
+    """
+
+    def __init__(self, maxsize=1024, on_evict=None, weigh=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.weigh = weigh
+        self.weight = 0
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def _weight(self, value):
+        return 1 if self.weigh is None else self.weigh(value)
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        data = self._data
+        if key in data:
+            self.weight -= self._weight(data[key])
+            data.move_to_end(key)
+        data[key] = value
+        self.weight += self._weight(value)
+        while data and self.weight > self.maxsize:
+            self._evicted(*data.popitem(last=False))
+
+    def pop(self, key, default=None):
+        if key not in self._data:
+            return default
+        value = self._data.pop(key)
+        self.weight -= self._weight(value)
+        return value
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.clear()
+        elif key in self._data:
+            self._evicted(key, self._data.pop(key))
+
+    def clear(self):
+        while self._data:
+            self._evicted(*self._data.popitem(last=False))
+
+    def _evicted(self, key, value):
+        self.weight -= self._weight(value)
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def keys(self):
+        return list(self._data.keys())
+
+
+def cached(method=None, ttl=60, stale=0, vary=()):
+    """Cache the responses of a handler method.
+
+    Use as ``@cached`` or ``@cached(ttl=300, stale=60, vary=['Cookie'])``.
+    Responses are served from the cache for ``ttl`` seconds, then for
+    ``stale`` more seconds while a single background render refreshes them.
+    ``vary`` names the request headers that are part of the cache key.
+    """
+    def decorate(method):
+        method.cache_ttl = ttl
+        method.cache_stale = stale
+        method.cache_vary = tuple(vary)
+        return method
+    if method is not None:
+        return decorate(method)
+    return decorate
+
+
+class BufferedResponse(object):
+    """Response stand-in collecting the output of a handler for the cache."""
+
+    headers_sent = False
+    status = 200
+
+    def __init__(self, content_type=None):
+        self.content_type = content_type
+        self.headers = []
+        self.chunks = []
+
+    @property
+    def started(self):
+        return bool(self.chunks)
+
+    def add_header(self, name, value):
+        self.headers.append((name, value))
+
+    def add_headers(self, *headers):
+        self.headers.extend(headers)
+
+    def send_headers(self):
+        pass
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def flush(self):
+        pass
+
+    def write_eof(self):
+        pass
+
+
+class CachedResponse(object):
+
+    __slots__ = ('status', 'headers', 'body', 'expires', 'stale_until')
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.expires = self.stale_until = 0.0
+
+    @property
+    def cacheable(self):
+        """Whether the response may be served to other requests.
+
+        Responses setting cookies belong to the request they answered.
+        """
+        return not any(name.lower() == 'set-cookie'
+                       for name, _ in self.headers)
+
+    def pack(self):
+        return pickle.dumps((self.status, self.headers, self.body,
+                             self.expires, self.stale_until), 2)
+
+    @classmethod
+    def unpack(cls, data):
+        status, headers, body, expires, stale_until = pickle.loads(data)
+        entry = cls(status, headers, body)
+        entry.expires, entry.stale_until = expires, stale_until
+        return entry
+
+
+# namespace of the responses in a shared cache
+_SHARED_PREFIX = b'response:'
+
+
+def _shared_key(key):
+    return _SHARED_PREFIX + pickle.dumps(key, 2)
+
+
+class ResponseCache(object):
+    """Rendered responses, bounded to ``maxbytes`` of body.
+
+    :meth:`fill` renders a missing key once however many requests wait for
+    it, :meth:`revalidate` refreshes a stale one in the background. With a
+    :class:`nacho.shm.SharedCache` (``shared``, or ``shm.cache`` when the
+    superviser created one) responses live there, shared by every worker,
+    and only those too large for a slot are kept in this process.
+    """
+
+    def __init__(self, maxbytes=32 * 1024 * 1024, shared=None):
+        self.entries = LRUCache(maxbytes, weigh=lambda entry: len(entry.body))
+        self._shared = shared
+        # key -> futures of the requests waiting for its render
+        self.filling = {}
+        # key -> future of the request the render was started for
+        self.owners = {}
+
+    @property
+    def shared(self):
+        return self._shared if self._shared is not None else shm.cache
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        shared = self.shared
+        if entry is None and shared is not None:
+            data = shared.get(_shared_key(key))
+            if data is not None:
+                entry = CachedResponse.unpack(data)
+        return entry
+
+    def set(self, key, entry):
+        shared = self.shared
+        if shared is None or not shared.set(
+                _shared_key(key), entry.pack(),
+                entry.stale_until - time.monotonic()):
+            self.entries.set(key, entry)
+
+    def fill(self, key, render, ttl, stale=0):
+        """Future of a fresh entry, starting ``render()`` unless running.
+
+        The result is None when the render was started for another request
+        and its response is not :attr:`~CachedResponse.cacheable`.
+        """
+        waiter = tulip.Future()
+        if key not in self.filling:
+            self.owners[key] = waiter
+        self.revalidate(key, render, ttl, stale)
+        self.filling[key].append(waiter)
+        return waiter
+
+    def revalidate(self, key, render, ttl, stale=0):
+        """Refresh ``key`` in the background with ``render()``."""
+        if key in self.filling:
+            return
+        self.filling[key] = []
+        # a task of its own, so a waiter going away does not cancel it
+        tulip.Task(render()).add_done_callback(
+            functools.partial(self._filled, key, ttl, stale))
+
+    def _filled(self, key, ttl, stale, task):
+        waiters = self.filling.pop(key, ())
+        owner = self.owners.pop(key, None)
+        if task.cancelled():
+            exc, entry = tulip.CancelledError(), None
+        else:
+            exc = task.exception()
+            entry = None if exc is not None else task.result()
+        shared = entry is not None and entry.cacheable
+        if shared:
+            entry.expires = time.monotonic() + ttl
+            entry.stale_until = entry.expires + stale
+            self.set(key, entry)
+        elif exc is not None and not waiters:
+            logging.warning('Revalidating %r failed: %r', key, exc)
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if exc is not None:
+                waiter.set_exception(exc)
+            else:
+                waiter.set_result(
+                    entry if shared or waiter is owner else None)
+
+    def invalidate(self, key=None):
+        self.entries.invalidate(key)
+        shared = self.shared
+        if shared is not None:
+            if key is None:
+                shared.clear(_SHARED_PREFIX)
+            else:
+                shared.delete(_shared_key(key))
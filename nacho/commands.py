@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+
+from nacho import static
+
+
+ARGS = argparse.ArgumentParser(prog='nacho', description="Nacho commands.")
+COMMANDS = ARGS.add_subparsers(dest='command')
+
+PRECOMPRESS = COMMANDS.add_parser(
+    'precompress', help='Write .gz siblings for the static files of a root.')
+PRECOMPRESS.add_argument(
+    'staticroot', action="store", help='Static root.')
+PRECOMPRESS.add_argument(
+    '--min-size', action="store", dest='min_size',
+    default=256, type=int, help='Skip files smaller than this many bytes.')
+PRECOMPRESS.add_argument(
+    '--level', action="store", dest='level',
+    default=9, type=int, help='gzip compression level.')
+
+
+def precompress(args):
+    total = saved = 0
+    for path, size, compressed in static.precompress(
+            args.staticroot, min_size=args.min_size, level=args.level):
+        print('{} {} -> {}'.format(path, size, compressed))
+        total += 1
+        saved += size - compressed
+    print('{} files compressed, {} bytes saved'.format(total, saved))
+
+
+def main(argv=None):
+    args = ARGS.parse_args(argv)
+    if args.command == 'precompress':
+        precompress(args)
+    else:
+        ARGS.print_help()
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
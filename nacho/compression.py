@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+import zlib
+
+
+# besides text/*, worth compressing
+COMPRESSIBLE_TYPES = frozenset([
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'application/xhtml+xml',
+    'application/rss+xml',
+    'application/atom+xml',
+    'application/x-javascript',
+    'image/svg+xml',
+    'image/x-icon',
+    'image/vnd.microsoft.icon',
+])
+
+
+def parse_accept_encoding(header):
+    """Parse an Accept-Encoding header into a ``{coding: qvalue}`` dict."""
+    codings = {}
+    if not header:
+        return codings
+    for item in header.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+
+def accepts_encoding(header, coding):
+    """Whether a client sending ``header`` accepts content ``coding``."""
+    codings = parse_accept_encoding(header)
+    q = codings.get(coding, codings.get('*', 0.0))
+    return q > 0
+
+
+def negotiate(header, available=('gzip', 'deflate')):
+    """Pick the best of the ``available`` codings for an Accept-Encoding.
+
+    Returns None for identity, which is also the answer when the client
+    sent no header or accepts none of them.
+    """
+    codings = parse_accept_encoding(header)
+    best, best_q = None, 0.0
+    for coding in available:
+        q = codings.get(coding, codings.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    if best is not None and codings.get('identity', 0.0) > best_q:
+        return None
+    return best
+
+
+def is_compressible(content_type, types=COMPRESSIBLE_TYPES):
+    if not content_type:
+        return False
+    content_type = content_type.split(';', 1)[0].strip().lower()
+    return content_type.startswith('text/') or content_type in types
+
+
+def compress(data, encoding, level=6):
+    """Compress a whole body with the gzip or deflate content coding."""
+    wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+import concurrent.futures
+import multiprocessing
+import os
+
+import tulip
+from tulip.http.errors import HttpErrorException
+
+
+class Executor(object):
+    """Bounded pool running blocking calls off the event loop.
+
+    At most ``max_workers`` calls run at once and ``max_queue`` more may
+    wait; beyond that :meth:`run` answers 503 instead of queueing. Calls
+    taking longer than ``timeout`` seconds answer 504 (the call itself
+    keeps its worker until it returns). The pool is created lazily in the
+    process that uses it, so it is never inherited across fork.
+    """
+
+    def __init__(self, max_workers=8, max_queue=64, timeout=None,
+                 process=False):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.process = process
+        self.pending = 0
+        self._pool = None
+        self._pid = None
+
+    @property
+    def pool(self):
+        if self._pool is None or self._pid != os.getpid():
+            factory = (concurrent.futures.ProcessPoolExecutor if self.process
+                       else concurrent.futures.ThreadPoolExecutor)
+            self._pool = factory(self.max_workers)
+            self._pid = os.getpid()
+            self.pending = 0
+        return self._pool
+
+    def _done(self, future):
+        self.pending -= 1
+
+    @tulip.coroutine
+    def run(self, func, *args, timeout=None):
+        if self.pending >= self.max_workers + self.max_queue:
+            raise HttpErrorException(503, message="Server busy")
+        loop = tulip.get_event_loop()
+        future = loop.run_in_executor(self.pool, func, *args)
+        self.pending += 1
+        future.add_done_callback(self._done)
+
+        timeout = timeout or self.timeout
+        if timeout:
+            done, _ = yield from tulip.wait([future], timeout=timeout)
+            if not done:
+                raise HttpErrorException(504, message="Handler timed out")
+        return (yield from future)
+
+    def shutdown(self, wait=True):
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.shutdown(wait)
+        self._pool = None
+
+
+# per worker process pools, see configure()
+threads = Executor()
+processes = Executor(max_workers=multiprocessing.cpu_count(), process=True)
+
+
+def configure(max_threads=None, max_processes=None, max_queue=None,
+              timeout=None):
+    """Size the module pools, call before workers are forked.
+
+    ``max_processes=0`` disables the process pool, None keeps one process
+    per CPU.
+    """
+    if max_threads:
+        threads.max_workers = max_threads
+    if max_processes is not None:
+        processes.max_workers = max_processes
+    for pool in (threads, processes):
+        if max_queue is not None:
+            pool.max_queue = max_queue
+        if timeout is not None:
+            pool.timeout = timeout
+
+
+def blocking(method=None, timeout=None):
+    """Mark a handler method as blocking, to run on the thread pool.
+
+    Use as ``@blocking`` or ``@blocking(timeout=5)``.
+    """
+    def decorate(method):
+        method.blocking = True
+        method.blocking_timeout = timeout
+        return method
+    if method is not None:
+        return decorate(method)
+    return decorate
+
+
+class LoopResponse(object):
+    """Response proxy handing writes from a worker thread to the loop."""
+
+    def __init__(self, loop, response):
+        self.loop = loop
+        self.response = response
+        self.detached = False
+        # set by the thread, its writes reach the response later
+        self.written = False
+
+    def _write(self, data):
+        if not self.detached:
+            self.response.write(data)
+
+    def write(self, data):
+        self.written = True
+        self.loop.call_soon_threadsafe(self._write, data)
+
+    def _flush(self):
+        if not self.detached:
+            self.response.flush()
+
+    def flush(self):
+        self.loop.call_soon_threadsafe(self._flush)
+
+    def _replace(self, build, args):
+        if not self.detached:
+            self.response = build(*args)
+
+    def replace(self, build, *args):
+        """Swap the proxied response for ``build(*args)``, built on the loop.
+        """
+        self.written = True
+        self.loop.call_soon_threadsafe(self._replace, build, args)
+
+    @property
+    def started(self):
+        return self.written or self.response.started
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
@@ -1,33 +1,384 @@
 #!/usr/bin/env python3
 import logging
+import socket
+import time
+import zlib
 
 import tulip
+import tulip.http
 from tulip.http import ServerHttpProtocol
 from tulip.http.errors import HttpErrorException
 
+from nacho import compression
+from nacho.metrics import metrics, CountingTransport
+
+
+# open connections of this process and whether it is shutting down
+connections = set()
+draining = False
+# nacho.profiler.Profiler of this process, when profiling
+profiler = None
+
+
+def drain_connections():
+    """Stop keeping connections alive and close the idle ones.
+
+    Connections that are handling a request or have received part of the
+    next one are left to finish it.
+    """
+    global draining
+    draining = True
+    for connection in list(connections):
+        if connection.idle and not connection.busy:
+            connection.transport.close()
+
+
+class Response(tulip.http.Response):
+    """Response that sends its headers with the first chunk of body.
+
+    Writes are held back until ``min_size`` bytes are buffered: a body that
+    ends before that goes out uncompressed with a Content-Length, together
+    with the headers in one write, a longer one is sent chunked and, if
+    ``encoding`` is set and the content type is compressible, compressed at
+    ``level``. With ``chunked=False`` (HTTP/1.0 clients) the whole body is
+    buffered so the connection can be kept alive. :meth:`send` sends a
+    complete body at once.
+
+    Chunked output is coalesced: small writes are buffered until
+    ``chunk_size`` bytes, :meth:`flush` or the end of the body, and each
+    chunk goes out framed in a single transport write.
+    """
+
+    def __init__(self, transport, status, http_version=(1, 1), close=False,
+                 content_type='text/html', encoding=None, min_size=0,
+                 level=6, compress_types=compression.COMPRESSIBLE_TYPES,
+                 chunk_size=16 * 1024, chunked=True):
+        super(Response, self).__init__(transport, status, http_version, close)
+        self.chunked_allowed = chunked
+        self.content_type = content_type
+        self.encoding = encoding
+        self.min_size = min_size
+        self.level = level
+        self.compress_types = compress_types
+        self.chunk_size = chunk_size
+        self._compressor = None
+        self._pending = []
+        self._pending_size = 0
+        # chunked output: framed bytes (headers) and body waiting to go out
+        self._head = []
+        self._body = None
+        self._body_size = 0
+
+    @property
+    def started(self):
+        """Whether a body was written or the headers were sent."""
+        return self.headers_sent or bool(self._pending)
+
+    def _start(self):
+        """Buffer the headers of a chunked body, then the pending writes."""
+        if self.content_type:
+            self.add_header('Content-type', self.content_type)
+        self.add_header('Transfer-Encoding', 'chunked')
+        if self.encoding and compression.is_compressible(
+                self.content_type, self.compress_types):
+            self.add_header('Content-Encoding', self.encoding)
+            self.add_header('Vary', 'Accept-Encoding')
+            wbits = (16 + zlib.MAX_WBITS if self.encoding == 'gzip'
+                     else zlib.MAX_WBITS)
+            self._compressor = zlib.compressobj(
+                self.level, zlib.DEFLATED, wbits)
+
+        transport, collector = self.transport, _Collector()
+        self.transport = collector
+        try:
+            self.send_headers()
+        finally:
+            self.transport = transport
+        self._head = collector.chunks
+        self._body = []
+
+        pending, self._pending = self._pending, None
+        for data in pending:
+            self._write(data)
+
+    def _write(self, data):
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        if not data:
+            return
+        if self._body is None:
+            # after send(), the body went out already
+            super(Response, self).write(data)
+            return
+        self._body.append(data)
+        self._body_size += len(data)
+        if self._body_size >= self.chunk_size:
+            self._flush()
+
+    def _flush(self, eof=False):
+        """Frame the buffered body and send it with one transport write."""
+        body, self._body, self._body_size = self._body, [], 0
+        transport, collector = self.transport, _Collector()
+        collector.chunks, self._head = self._head, []
+        self.transport = collector
+        try:
+            if body:
+                super(Response, self).write(b''.join(body))
+            result = super(Response, self).write_eof() if eof else None
+        finally:
+            self.transport = transport
+        if collector.chunks:
+            transport.write(b''.join(collector.chunks))
+        return result
+
+    def write(self, data):
+        if self.headers_sent:
+            return self._write(data)
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self.chunked_allowed and self._pending_size >= self.min_size:
+            self._start()
+
+    def flush(self):
+        """Send what was written so far, e.g. before a slow operation."""
+        if not self.headers_sent:
+            if not self.chunked_allowed or not self._pending:
+                return
+            self._start()
+        if self._body is None:
+            return
+        if self._compressor is not None:
+            data = self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                self._body.append(data)
+        self._flush()
+
+    def send(self, body=b''):
+        """Send the whole response, ``body`` after any pending writes.
+
+        Status line, headers and body go out in a single transport write,
+        with a Content-Length; a body of ``min_size`` bytes or more is
+        compressed in one go when an encoding was negotiated.
+        """
+        pending, self._pending = self._pending, None
+        if pending:
+            pending.append(body)
+            body = b''.join(pending)
+        if self.content_type:
+            self.add_header('Content-type', self.content_type)
+        if self.encoding and len(body) >= self.min_size and \
+                compression.is_compressible(self.content_type,
+                                            self.compress_types):
+            body = compression.compress(body, self.encoding, self.level)
+            self.add_header('Content-Encoding', self.encoding)
+            self.add_header('Vary', 'Accept-Encoding')
+        self.add_header('Content-Length', str(len(body)))
+
+        transport, collector = self.transport, _Collector()
+        self.transport = collector
+        try:
+            self.send_headers()
+            if body:
+                super(Response, self).write(body)
+        finally:
+            self.transport = transport
+        transport.write(b''.join(collector.chunks))
+
+    def write_eof(self):
+        if not self.headers_sent:
+            self.send()
+        if self._body is None:
+            return super(Response, self).write_eof()
+        if self._compressor is not None:
+            data = self._compressor.flush()
+            self._compressor = None
+            if data:
+                self._body.append(data)
+        return self._flush(eof=True)
+
+
+class _Collector(object):
+    """Transport stand-in gathering writes to pass them on at once."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+
+def send_buffer_chunk_size(transport, default=16 * 1024,
+                           low=4 * 1024, high=256 * 1024):
+    """Chunk size matching the socket send buffer of ``transport``.
+
+    Half of ``SO_SNDBUF`` (Linux reports twice the usable size), so one
+    chunk fills the buffer without overrunning it, between ``low`` and
+    ``high`` bytes.
+    """
+    sock = transport.get_extra_info('socket')
+    if not isinstance(sock, socket.socket):
+        return default
+    try:
+        size = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+    except OSError:
+        return default
+    return min(max(size // 2, low), high)
+
+
+class FlowControlledPayload(object):
+    """Request body stream applying backpressure to the connection.
+
+    Reading from the socket is paused while more than ``high_water`` bytes
+    of body were received but not read by the handler, and resumed once
+    it read them down to half of that.
+    """
+
+    def __init__(self, transport, payload, high_water=256 * 1024):
+        self.transport = transport
+        self.payload = payload
+        self.high_water = high_water
+        self.buffered = 0
+        self.paused = False
+        feed_data = payload.feed_data
+
+        def feed(data):
+            feed_data(data)
+            self.buffered += len(data)
+            if self.buffered > self.high_water and not self.paused:
+                self.paused = True
+                self.transport.pause()
+        try:
+            payload.feed_data = feed
+        except AttributeError:  # pragma: no cover
+            pass
+
+    def resume(self):
+        if self.paused:
+            self.paused = False
+            self.transport.resume()
+
+    @tulip.coroutine
+    def read(self):
+        chunk = yield from self.payload.read()
+        if chunk:
+            self.buffered = max(self.buffered - len(chunk), 0)
+        if self.buffered <= self.high_water // 2:
+            self.resume()
+        return chunk
+
+    def __getattr__(self, name):
+        return getattr(self.payload, name)
+
+
 class HttpServer(ServerHttpProtocol):
-    def __init__(self, router, *args, **kwargs):
+    """HTTP protocol dispatching requests to the handlers of a Router.
+
+    Connections are kept alive between requests (HTTP/1.1 by default,
+    HTTP/1.0 with ``Connection: keep-alive``) until ``max_requests`` were
+    served or the ``keep_alive`` idle timeout expires. Pipelined requests
+    are read from the stream and answered one at a time, in order.
+    """
+
+    # unread request bodies larger than this close the connection
+    max_drain_size = 64 * 1024
+    # request body bytes buffered before reading from the socket pauses
+    max_buffered_body = 256 * 1024
+
+    def __init__(self, router, *args, max_requests=100, **kwargs):
         super(HttpServer, self).__init__(*args, **kwargs)
         self.router = router
+        self.max_requests = max_requests
+        self.requests = 0
+        self.closing = True
+        self.busy = False
+        # no byte of a request received since the last one was answered
+        self.idle = True
+        self.chunk_size = 16 * 1024
+        self.profiled = False
+        self.route = None
+
+    def connection_made(self, transport):
+        self.chunk_size = send_buffer_chunk_size(transport)
+        super(HttpServer, self).connection_made(CountingTransport(transport))
+        connections.add(self)
+
+    def data_received(self, data):
+        self.idle = False
+        super(HttpServer, self).data_received(data)
+
+    def connection_lost(self, exc):
+        super(HttpServer, self).connection_lost(exc)
+        connections.discard(self)
+
+    def should_close(self, message):
+        """Whether the connection must be closed after ``message``."""
+        if draining:
+            return True
+        if self.max_requests and self.requests >= self.max_requests:
+            return True
+        return getattr(message, 'should_close', message.version < (1, 1))
+
+    def response(self, status, message=None, **kwargs):
+        """Build a Response honoring the keep-alive state of the request."""
+        message = message or self.message
+        if kwargs.get('chunk_size') is None:
+            kwargs['chunk_size'] = self.chunk_size
+        return Response(self.transport, status, close=self.closing,
+                        chunked=message.version >= (1, 1), **kwargs)
+
+    @tulip.coroutine
+    def drain(self, payload):
+        """Discard what the handlers left unread of the request body."""
+        size = 0
+        while size <= self.max_drain_size:
+            chunk = yield from payload.read()
+            if not chunk:
+                return True
+            size += len(chunk)
+        return False
 
     @tulip.coroutine
     def handle_request(self, message, payload):
-        response = None
+        metrics.requests += 1
+        metrics.in_flight += 1
+        self.busy = True
+        self.profiled = profiler is not None and profiler.sample()
+        if self.profiled:
+            self.route = self.router.get_route(message.path)
+            profiler.active += 1
+        start = time.monotonic()
+        payload = FlowControlledPayload(
+            self.transport, payload, self.max_buffered_body)
+        try:
+            yield from self._handle_request(message, payload)
+        finally:
+            payload.resume()
+            if self.profiled:
+                self.profiled = False
+                profiler.active -= 1
+            self.busy = False
+            # bytes of a pipelined next request may wait in the stream
+            self.idle = not getattr(self.stream, '_buffer', None)
+            metrics.in_flight -= 1
+            metrics.observe(time.monotonic() - start)
+
+    @tulip.coroutine
+    def _handle_request(self, message, payload):
         logging.debug('method = {!r}; path = {!r}; version = {!r}'.format(
             message.method, message.path, message.version))
+        self.requests += 1
+        self.message = message
+        self.closing = self.should_close(message)
 
         handlers, args = self.router.get_handler(message.path)
-        if handlers:
-            for handler in handlers:
-                logging.debug("handler: %s", handler)
-                handler.initialize(self, message, payload, prev_response=response)
-                result = handler(request_args=args)
-                response = handler.response
-            if not response:
-                raise HttpErrorException(404, message="No Handler found")
-        else:
+        if not handlers:
             raise HttpErrorException(404)
+        response = yield from handlers.run(self, message, payload, args)
+        if not response:
+            raise HttpErrorException(404, message="No Handler found")
 
         response.write_eof()
-        if response.keep_alive():
-            self.keep_alive(True)
+        keep_alive = response.keep_alive()
+        if keep_alive:
+            keep_alive = yield from self.drain(payload)
+        self.keep_alive(keep_alive)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+import bisect
+import logging
+import struct
+import sys
+import threading
+import time
+import traceback
+
+import tulip
+
+from nacho.profiler import walk_stack
+
+
+# upper bounds in seconds of the request latency histogram
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+# requests, in flight, bytes out, latency sum, loop lag, stalls, then the
+# buckets (the last one counting requests slower than every bound)
+_FRAME = struct.Struct('!QIQddQ{}Q'.format(len(LATENCY_BUCKETS) + 1))
+
+
+class Metrics(object):
+    """Counters of one worker process, sent to the superviser as stats."""
+
+    def __init__(self):
+        self.requests = 0
+        self.in_flight = 0
+        self.bytes_out = 0
+        self.latency_sum = 0.0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.loop_lag = 0.0
+        self.stalls = 0
+
+    def observe(self, duration):
+        self.latency_sum += duration
+        self.latency_buckets[bisect.bisect_left(LATENCY_BUCKETS,
+                                                duration)] += 1
+
+    def encode(self):
+        return _FRAME.pack(
+            self.requests, self.in_flight, self.bytes_out, self.latency_sum,
+            self.loop_lag, self.stalls, *self.latency_buckets)
+
+    @classmethod
+    def decode(cls, data):
+        values = _FRAME.unpack(data)
+        stats = cls()
+        (stats.requests, stats.in_flight, stats.bytes_out,
+         stats.latency_sum, stats.loop_lag, stats.stalls) = values[:6]
+        stats.latency_buckets = list(values[6:])
+        return stats
+
+    def add(self, other):
+        self.requests += other.requests
+        self.in_flight += other.in_flight
+        self.bytes_out += other.bytes_out
+        self.latency_sum += other.latency_sum
+        self.loop_lag = max(self.loop_lag, other.loop_lag)
+        self.stalls += other.stalls
+        self.latency_buckets = [a + b for a, b in zip(
+            self.latency_buckets, other.latency_buckets)]
+
+
+# this process
+metrics = Metrics()
+
+
+class CountingTransport(object):
+    """Transport proxy adding every written byte to ``metrics.bytes_out``."""
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def write(self, data):
+        metrics.bytes_out += len(data)
+        self.transport.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+
+@tulip.task
+def monitor_loop_lag(interval=0.5, window=10):
+    """Keep ``metrics.loop_lag`` at the worst timer drift of a window."""
+    worst, ticks = 0.0, 0
+    while True:
+        start = time.monotonic()
+        yield from tulip.sleep(interval)
+        worst = max(worst, time.monotonic() - start - interval)
+        ticks += 1
+        if ticks >= window:
+            metrics.loop_lag, worst, ticks = worst, 0.0, 0
+        else:
+            metrics.loop_lag = max(metrics.loop_lag, worst)
+
+
+def request_context(frame):
+    """The request path and handler class found on the stack of ``frame``."""
+    path = handler = None
+    for frame, obj, handler in walk_stack(frame):
+        message = getattr(obj, 'message', None)
+        if path is None and hasattr(obj, 'router') and message is not None:
+            path = '{} {}'.format(message.method, message.path)
+    return path, handler
+
+
+class Watchdog(threading.Thread):
+    """Log what the event loop runs whenever it is blocked too long.
+
+    A timer on the loop bumps a timestamp every ``threshold / 2`` seconds
+    and a daemon thread checks it at the same pace. Once the timer is late
+    by more than ``threshold``, the loop thread is still inside the slow
+    callback, so its stack is logged together with the request and handler
+    on it. Each stall is reported once and counted in ``metrics.stalls``.
+    """
+
+    def __init__(self, loop, threshold=0.5, limit=16):
+        super(Watchdog, self).__init__(name='nacho-watchdog', daemon=True)
+        self.loop = loop
+        self.threshold = threshold
+        self.limit = limit
+        self.interval = threshold / 2
+        self.tick = time.monotonic()
+        self.loop_thread = None
+        self.stopped = threading.Event()
+        self._timer = None
+
+    def start(self):
+        """Start watching, call from the thread running ``loop``."""
+        self.loop_thread = threading.get_ident()
+        self._beat()
+        super(Watchdog, self).start()
+
+    def stop(self):
+        """Stop watching, call from the thread running ``loop``."""
+        self.stopped.set()
+        if self._timer is not None:
+            self._timer.cancel()
+
+    def _beat(self):
+        self.tick = time.monotonic()
+        if not self.stopped.is_set():
+            self._timer = self.loop.call_later(self.interval, self._beat)
+
+    def run(self):
+        reported = None
+        while not self.stopped.wait(self.interval):
+            tick = self.tick
+            late = time.monotonic() - tick - self.interval
+            if late > self.threshold and tick != reported:
+                reported = tick
+                metrics.stalls += 1
+                frame = sys._current_frames().get(self.loop_thread)
+                if frame is not None:
+                    self.report(frame, late)
+
+    def report(self, frame, late):
+        path, handler = request_context(frame)
+        stack = ''.join(traceback.format_stack(frame, self.limit))
+        logging.warning(
+            'Event loop blocked for %.3fs; request = %s; handler = %s\n%s',
+            late, path or '-', handler or '-', stack)
+
+
+def _line(name, value, labels=None):
+    if labels:
+        name += '{' + ','.join('{}="{}"'.format(key, val)
+                               for key, val in sorted(labels.items())) + '}'
+    return '{} {}'.format(name, value)
+
+
+def prometheus(workers, retired=None):
+    """Render ``{pid: Metrics}`` in the Prometheus text exposition format.
+
+    ``retired`` holds the totals of workers that are gone, so counters
+    stay monotonic across worker restarts.
+    """
+    total = Metrics()
+    if retired is not None:
+        total.add(retired)
+    for stats in workers.values():
+        total.add(stats)
+    total.in_flight = sum(stats.in_flight for stats in workers.values())
+
+    lines = []
+
+    def family(name, kind, description, value, per_worker=None):
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        lines.append(_line(name, value))
+        if per_worker is not None:
+            for pid, stats in sorted(workers.items()):
+                lines.append(_line(name, per_worker(stats), {'worker': pid}))
+
+    family('nacho_requests_total', 'counter', 'Requests served.',
+           total.requests, lambda stats: stats.requests)
+    family('nacho_requests_in_flight', 'gauge', 'Requests being handled.',
+           total.in_flight, lambda stats: stats.in_flight)
+    family('nacho_bytes_out_total', 'counter', 'Bytes written to clients.',
+           total.bytes_out, lambda stats: stats.bytes_out)
+    family('nacho_loop_lag_seconds', 'gauge', 'Worst recent event loop lag.',
+           total.loop_lag, lambda stats: stats.loop_lag)
+    family('nacho_loop_stalls_total', 'counter',
+           'Times the event loop was blocked past the watchdog threshold.',
+           total.stalls, lambda stats: stats.stalls)
+    family('nacho_workers', 'gauge', 'Worker processes reporting.',
+           len(workers))
+
+    name = 'nacho_request_duration_seconds'
+    lines.append('# HELP {} Request handling latency.'.format(name))
+    lines.append('# TYPE {} histogram'.format(name))
+    count = 0
+    for bound, bucket in zip(LATENCY_BUCKETS + ('+Inf',),
+                             total.latency_buckets):
+        count += bucket
+        lines.append(_line(name + '_bucket', count, {'le': bound}))
+    lines.append(_line(name + '_sum', total.latency_sum))
+    lines.append(_line(name + '_count', count))
+    return '\n'.join(lines) + '\n'
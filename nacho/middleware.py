@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+import tulip
+
+
+@tulip.coroutine
+def _resolve(result):
+    if tulip.iscoroutine(result) or isinstance(result, tulip.Future):
+        result = yield from result
+    return result
+
+
+class Middleware(object):
+    """Hooks wrapping the handlers of a route.
+
+    ``before(handler)`` runs first; returning a response (e.g. from
+    ``handler.json(...)``) answers the request without running anything
+    further in. ``after(handler, response)`` runs once the inner handlers
+    are done and may return a replacement response. Overriding
+    ``around(handler, call_next)`` takes over both: ``yield from
+    call_next(handler)`` runs the inner handlers and returns their
+    response. Hooks may be coroutines. ``handler`` is the first handler of
+    the route, bound to the request, with the route arguments as
+    ``handler.request_args``.
+    """
+
+    def before(self, handler):
+        return None
+
+    def after(self, handler, response):
+        return None
+
+    @tulip.coroutine
+    def around(self, handler, call_next):
+        response = yield from _resolve(self.before(handler))
+        if response is not None:
+            return response
+        response = yield from call_next(handler)
+        result = yield from _resolve(self.after(handler, response))
+        return response if result is None else result
+
+    def wrap(self, call_next):
+        """Compose this middleware around ``call_next``, once per route."""
+        around = self.around
+
+        def call(handler):
+            return around(handler, call_next)
+        return call
+
+
+class Pipeline(list):
+    """The handlers of a route with its middleware composed around them.
+
+    The composition happens ahead of requests, in :meth:`compose`; a
+    request only runs :meth:`run`.
+    """
+
+    def __init__(self, handlers, middleware=()):
+        super(Pipeline, self).__init__(handlers)
+        self.middleware = list(middleware)
+        self.compose()
+
+    def compose(self, outer=()):
+        """Build the chain, ``outer`` middleware around the route's own."""
+        call = self._handlers
+        for layer in reversed(list(outer) + self.middleware):
+            call = layer.wrap(call)
+        self._call = call
+
+    @tulip.coroutine
+    def run(self, server, message, payload, args):
+        """Run the route for a request and return its response."""
+        if not self:
+            return None
+        handler = self[0].for_request(server, message, payload)
+        handler.request_args = args
+        return (yield from _resolve(self._call(handler)))
+
+    @tulip.coroutine
+    def _handlers(self, handler):
+        args = handler.request_args
+        result = handler(request_args=args)
+        if tulip.iscoroutine(result) or isinstance(result, tulip.Future):
+            yield from result
+        response = handler.response
+        for template in self[1:]:
+            handler = template.for_request(
+                handler.server, handler.request, handler.payload,
+                prev_response=response)
+            result = handler(request_args=args)
+            if tulip.iscoroutine(result) or isinstance(result, tulip.Future):
+                yield from result
+            response = handler.response
+        return response
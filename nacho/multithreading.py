@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
+import importlib
 import os
+import random
+import resource
 import socket
 import signal
+import sys
 import time
 import tulip
 import argparse
 import tulip.http
 from tulip.http import websocket
+
+from nacho import executor, http, metrics, profiler, shm
 try:
     import ssl
 except ImportError:  # pragma: no cover
@@ -31,11 +37,177 @@ ARGS.add_argument(
 ARGS.add_argument(
     '--workers', action="store", dest='workers',
     default=1, type=int, help='Number of workers.')
+ARGS.add_argument(
+    '--reuseport', action="store_true", dest='reuseport',
+    help='Each worker binds its own SO_REUSEPORT socket.')
+ARGS.add_argument(
+    '--backlog', action="store", dest='backlog',
+    default=1024, type=int, help='listen() backlog.')
+ARGS.add_argument(
+    '--graceful-timeout', action="store", dest='graceful_timeout',
+    default=30, type=float,
+    help='Seconds a reloaded worker may spend finishing its connections.')
+ARGS.add_argument(
+    '--max-requests', action="store", dest='max_requests',
+    default=0, type=int,
+    help='Replace a worker after this many requests, 0 disables.')
+ARGS.add_argument(
+    '--max-requests-jitter', action="store", dest='max_requests_jitter',
+    default=0, type=int,
+    help='Add up to this many requests to --max-requests per worker.')
+ARGS.add_argument(
+    '--max-rss', action="store", dest='max_rss',
+    default=0, type=int,
+    help='Replace a worker whose resident memory exceeds this many MB.')
+ARGS.add_argument(
+    '--stats-interval', action="store", dest='stats_interval',
+    default=5, type=float, help='Seconds between worker stats reports.')
+ARGS.add_argument(
+    '--slow-callback', action="store", dest='slow_callback',
+    default=0.5, type=float,
+    help='Log a stack sample when the event loop is blocked this many '
+         'seconds, 0 disables.')
+ARGS.add_argument(
+    '--profile-rate', action="store", dest='profile_rate',
+    default=0, type=float,
+    help='Fraction of requests to profile, 0 disables. SIGUSR2 dumps '
+         'the samples of every worker.')
+ARGS.add_argument(
+    '--profile-interval', action="store", dest='profile_interval',
+    default=0.005, type=float, help='Seconds between profiler samples.')
+ARGS.add_argument(
+    '--profile-dir', action="store", dest='profile_dir',
+    default=None, help='Directory of the profile dumps, the temp dir '
+                       'by default.')
+ARGS.add_argument(
+    '--admin-port', action="store", dest='admin_port',
+    default=0, type=int,
+    help='Serve aggregated worker metrics on this port, 0 disables.')
+ARGS.add_argument(
+    '--admin-host', action="store", dest='admin_host',
+    default='127.0.0.1', help='Admin host name.')
+ARGS.add_argument(
+    '--max-workers', action="store", dest='max_workers',
+    default=0, type=int,
+    help='Autoscale between --workers and this many workers, 0 disables.')
+ARGS.add_argument(
+    '--scale-interval', action="store", dest='scale_interval',
+    default=5, type=float, help='Seconds between autoscaling decisions.')
+ARGS.add_argument(
+    '--scale-up-in-flight', action="store", dest='scale_up_in_flight',
+    default=8, type=float,
+    help='Average in-flight requests per worker that counts as busy.')
+ARGS.add_argument(
+    '--scale-down-in-flight', action="store", dest='scale_down_in_flight',
+    default=1, type=float,
+    help='Average in-flight requests per worker that counts as idle.')
+ARGS.add_argument(
+    '--scale-up-lag', action="store", dest='scale_up_lag',
+    default=0.1, type=float, help='Event loop lag in seconds that counts as busy.')
+ARGS.add_argument(
+    '--scale-up-after', action="store", dest='scale_up_after',
+    default=3, type=int, help='Busy intervals in a row before adding a worker.')
+ARGS.add_argument(
+    '--scale-down-after', action="store", dest='scale_down_after',
+    default=24, type=int,
+    help='Idle intervals in a row before retiring a worker.')
+ARGS.add_argument(
+    '--shared-cache', action="store", dest='shared_cache',
+    default=0, type=int,
+    help='MB of shared memory cache for all workers, 0 disables.')
+ARGS.add_argument(
+    '--shared-cache-slot', action="store", dest='shared_cache_slot',
+    default=64, type=int, help='KB per shared memory cache entry.')
+ARGS.add_argument(
+    '--threads', action="store", dest='threads',
+    default=8, type=int, help='Blocking handler threads per worker.')
+ARGS.add_argument(
+    '--processes', action="store", dest='processes',
+    default=None, type=int,
+    help='CPU-bound processes per worker, one per CPU by default, 0 disables.')
+ARGS.add_argument(
+    '--max-queue', action="store", dest='max_queue',
+    default=64, type=int, help='Blocking calls allowed to wait for a thread.')
+ARGS.add_argument(
+    '--blocking-timeout', action="store", dest='blocking_timeout',
+    default=None, type=float, help='Seconds before a blocking call is a 504.')
 ARGS.add_argument(
     '--staticroot', action="store", dest='staticroot',
     default='./static/', type=str, help='Static root.')
 
 
+def load_factory(protocol_factory):
+    """Resolve a ``'module:callable'`` protocol factory.
+
+    Passing the factory as a string keeps the application out of the
+    supervisor, so every forked worker imports the code fresh from disk.
+    """
+    if not isinstance(protocol_factory, str):
+        return protocol_factory
+    module, _, name = protocol_factory.partition(':')
+    factory = importlib.import_module(module)
+    for attr in name.split('.'):
+        factory = getattr(factory, attr)
+    return factory
+
+
+def current_rss():
+    """Resident set size of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        # peak rather than current, in KB on Linux and bytes on OS X
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def bind_socket(host, port, backlog=1024, reuseport=False):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def worker_load(stats):
+    """Average in-flight requests and worst loop lag of worker stats."""
+    in_flight = sum(s.in_flight for s in stats) / len(stats)
+    return in_flight, max(s.loop_lag for s in stats)
+
+
+def scale_decision(args, stats, workers, busy=0, idle=0):
+    """One autoscaling step from the latest stats of the ``workers``.
+
+    ``busy`` and ``idle`` are the streaks returned by the previous step.
+    Only load that persists for --scale-up-after (or idleness for
+    --scale-down-after) steps in a row changes the worker count, and the
+    streak restarts after each change, so short spikes do not make the
+    pool flap. Returns ``(change, busy, idle)``, ``change`` being 1 to add
+    a worker, -1 to retire one or 0.
+    """
+    if not stats:
+        return 0, busy, idle
+    in_flight, lag = worker_load(stats)
+
+    if in_flight >= args.scale_up_in_flight or lag >= args.scale_up_lag:
+        busy, idle = busy + 1, 0
+    elif in_flight <= args.scale_down_in_flight and \
+            lag < args.scale_up_lag / 2:
+        busy, idle = 0, idle + 1
+    else:
+        busy = idle = 0
+
+    if busy >= args.scale_up_after and workers < args.max_workers:
+        return 1, 0, idle
+    if idle >= args.scale_down_after and workers > args.workers:
+        return -1, busy, 0
+    return 0, busy, idle
+
+
 class ChildProcess:
 
     def __init__(self, up_read, down_write, args, sock, protocol_factory, ssl):
@@ -45,6 +217,7 @@ class ChildProcess:
         self.sock = sock
         self.protocol_factory = protocol_factory
         self.ssl = ssl
+        self.draining = False
 
     def start(self):
         # start server
@@ -55,13 +228,32 @@ class ChildProcess:
             self.loop.stop()
             os._exit(0)
         loop.add_signal_handler(signal.SIGINT, stop)
+        # SIGHUP reloads through the superviser, not the workers
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        if self.sock is None:
+            # --reuseport, the kernel balances connections between workers
+            self.sock = bind_socket(self.args.host, self.args.port,
+                                    self.args.backlog, reuseport=True)
 
         f = loop.start_serving(
-            self.protocol_factory, sock=self.sock, ssl=self.ssl)
-        x = loop.run_until_complete(f)[0]
+            load_factory(self.protocol_factory), sock=self.sock, ssl=self.ssl)
+        self.servers = loop.run_until_complete(f)
+        x = self.servers[0]
         print('Starting srv worker process {} on {}'.format(
             os.getpid(), x.getsockname()))
 
+        if self.args.slow_callback:
+            metrics.Watchdog(loop, self.args.slow_callback).start()
+        if self.args.profile_rate:
+            http.profiler = profiler.Profiler(
+                self.args.profile_rate, self.args.profile_interval,
+                self.args.profile_dir)
+            http.profiler.start()
+            loop.add_signal_handler(signal.SIGUSR2, http.profiler.dump)
+        else:
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+
         # heartbeat
         self.heartbeat()
 
@@ -78,6 +270,9 @@ class ChildProcess:
 
         reader = read_proto.set_parser(websocket.WebSocketParser())
         writer = websocket.WebSocketWriter(write_transport)
+        writer.send('ready')
+        self.recycle(writer)
+        self.report(writer)
 
         while True:
             msg = yield from reader.read()
@@ -87,28 +282,97 @@ class ChildProcess:
                 break
             elif msg.tp == websocket.MSG_PING:
                 writer.pong()
+            elif msg.tp == websocket.MSG_TEXT:
+                command, _, arg = msg.data.partition(' ')
+                if command == 'drain':
+                    self.drain(float(arg))
             elif msg.tp == websocket.MSG_CLOSE:
                 break
 
         read_transport.close()
         write_transport.close()
 
+    @tulip.task
+    def report(self, writer):
+        """Push this worker's stats to the superviser as binary frames."""
+        metrics.monitor_loop_lag()
+        while True:
+            yield from tulip.sleep(self.args.stats_interval)
+            writer.send(metrics.metrics.encode(), binary=True)
+
+    @tulip.task
+    def recycle(self, writer, interval=1):
+        """Ask to be replaced once over --max-requests or --max-rss.
+
+        The request is repeated every --graceful-timeout seconds until the
+        superviser drains this worker, in case its replacement failed.
+        """
+        max_requests = self.args.max_requests
+        if max_requests:
+            max_requests += random.randint(0, self.args.max_requests_jitter)
+        max_rss = self.args.max_rss * 1024 * 1024
+        if not max_requests and not max_rss:
+            return
+
+        asked = None
+        while True:
+            yield from tulip.sleep(interval)
+            if self.draining:
+                return
+            if asked is not None and \
+                    time.monotonic() - asked < self.args.graceful_timeout:
+                continue
+            if max_requests and metrics.metrics.requests >= max_requests:
+                reason = '{} requests'.format(metrics.metrics.requests)
+            elif max_rss and current_rss() > max_rss:
+                reason = '{} bytes rss'.format(current_rss())
+            else:
+                continue
+            print('Recycle worker process {} after {}'.format(
+                os.getpid(), reason))
+            writer.send('recycle')
+            asked = time.monotonic()
+
+    @tulip.task
+    def drain(self, timeout):
+        """Stop accepting, let open connections finish, then exit.
+
+        With --reuseport the listening socket is this worker's own: closing
+        it resets the connections still queued in its backlog.
+        """
+        print('Draining worker process {}'.format(os.getpid()))
+        self.draining = True
+        for sock in self.servers:
+            self.loop.stop_serving(sock)
+        http.drain_connections()
+
+        deadline = time.monotonic() + timeout
+        while http.connections and time.monotonic() < deadline:
+            yield from tulip.sleep(0.1)
+        self.loop.stop()
+
 
 class Worker:
 
     _started = False
 
-    def __init__(self, loop, args, sock, protocol_factory, ssl):
+    def __init__(self, loop, args, sock, protocol_factory, ssl,
+                 on_recycle=None, on_exit=None):
         self.loop = loop
         self.args = args
         self.sock = sock
         self.protocol_factory = protocol_factory
         self.ssl = ssl
+        self.on_recycle = on_recycle
+        self.on_exit = on_exit
         self.start()
 
     def start(self):
         assert not self._started
         self._started = True
+        self.retiring = False
+        self.ready = tulip.Future()
+        self.stats = None
 
         up_read, up_write = os.pipe()
         down_read, down_write = os.pipe()
@@ -152,6 +416,10 @@ class Worker:
         while True:
             msg = yield from reader.read()
             if msg is None:
+                if self.retiring:
+                    # drained and exited
+                    self.close()
+                    return
                 print('Restart unresponsive worker process: {}'.format(
                     self.pid))
                 self.kill()
@@ -159,6 +427,13 @@ class Worker:
                 return
             elif msg.tp == websocket.MSG_PONG:
                 self.ping = time.monotonic()
+            elif msg.tp == websocket.MSG_BINARY:
+                self.stats = metrics.Metrics.decode(msg.data)
+            elif msg.tp == websocket.MSG_TEXT:
+                if msg.data == 'ready' and not self.ready.done():
+                    self.ready.set_result(self.pid)
+                elif msg.data == 'recycle' and self.on_recycle is not None:
+                    self.on_recycle(self)
 
     @tulip.task
     def connect(self, pid, up_write, down_read):
@@ -177,16 +452,41 @@ class Worker:
         self.ping = time.monotonic()
         self.rtransport = read_transport
         self.wtransport = write_transport
+        self.writer = writer
         self.chat_task = self.chat(reader)
         self.heartbeat_task = self.heartbeat(writer)
 
-    def kill(self):
+    def close(self):
         self._started = False
+        if self.on_exit is not None:
+            self.on_exit(self)
+        self.stats = None
         self.chat_task.cancel()
         self.heartbeat_task.cancel()
         self.rtransport.close()
         self.wtransport.close()
-        os.kill(self.pid, signal.SIGTERM)
+
+    def kill(self, sig=signal.SIGTERM):
+        self.close()
+        try:
+            os.kill(self.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def drain(self, timeout):
+        """Ask the worker to finish its connections and exit."""
+        self.retiring = True
+        if not self._started:
+            return
+        self.heartbeat_task.cancel()
+        self.writer.send('drain {}'.format(timeout))
+
+        def force():
+            if self._started:
+                print('Kill worker process {} after drain timeout'.format(
+                    self.pid))
+                self.kill(signal.SIGKILL)
+        self.loop.call_later(timeout + 5, force)
 
 
 class Superviser:
@@ -198,6 +498,9 @@ class Superviser:
             args.host, port = args.host.split(':', 1)
             args.port = int(port)
 
+        if args.reuseport and not hasattr(socket, 'SO_REUSEPORT'):
+            ARGS.error('--reuseport is not supported on this platform')
+
         if args.iocp:
             from tulip import windows_events
             sys.argv.remove('--iocp')
@@ -221,20 +524,160 @@ class Superviser:
             sslcontext = None
         self.ssl = sslcontext
 
+        executor.configure(
+            max_threads=args.threads, max_processes=args.processes,
+            max_queue=args.max_queue, timeout=args.blocking_timeout)
+        if args.shared_cache:
+            # before forking, so every worker maps the same memory
+            shm.cache = shm.SharedCache(args.shared_cache * 1024 * 1024,
+                                        args.shared_cache_slot * 1024)
+
         self.args = args
         self.workers = []
+        # workers being drained after a reload or recycle
+        self.draining = []
+        # totals of the workers that exited, see collect()
+        self.retired = metrics.Metrics()
 
     def start(self, protocol_factory):
-        # bind socket
-        sock = self.sock = socket.socket()
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind((self.args.host, self.args.port))
-        sock.listen(1024)
-        sock.setblocking(False)
+        # bind socket, shared by all workers unless each binds its own
+        if self.args.reuseport:
+            sock = self.sock = None
+        else:
+            sock = self.sock = bind_socket(
+                self.args.host, self.args.port, self.args.backlog)
 
         # start processes
+        self.protocol_factory = protocol_factory
         for idx in range(self.args.workers):
-            self.workers.append(Worker(self.loop, self.args, sock, protocol_factory, self.ssl))
+            self.workers.append(self.spawn())
+
+        if self.args.admin_port:
+            self.loop.run_until_complete(self.loop.start_serving(
+                lambda: AdminServer(self),
+                self.args.admin_host, self.args.admin_port))
+
+        if self.args.max_workers > self.args.workers:
+            self.autoscale()
 
         self.loop.add_signal_handler(signal.SIGINT, lambda: self.loop.stop())
+        self.loop.add_signal_handler(signal.SIGHUP, self.reload)
+        self.loop.add_signal_handler(signal.SIGCHLD, self.reap)
+        self.loop.add_signal_handler(signal.SIGUSR2, self.dump_profiles)
         self.loop.run_forever()
+
+    def reap(self):
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+
+    def dump_profiles(self):
+        """Have every worker dump its profiler samples."""
+        for worker in self.workers + self.draining:
+            try:
+                os.kill(worker.pid, signal.SIGUSR2)
+            except ProcessLookupError:
+                pass
+
+    def spawn(self):
+        return Worker(self.loop, self.args, self.sock, self.protocol_factory,
+                      self.ssl, on_recycle=self.replace, on_exit=self.collect)
+
+    def collect(self, worker):
+        """Forget an exiting worker, keeping its counters in the totals."""
+        if worker in self.draining:
+            self.draining.remove(worker)
+        # drained before its first stats frame
+        if worker.stats is None:
+            return
+        self.retired.add(worker.stats)
+        self.retired.in_flight = 0
+        self.retired.loop_lag = 0.0
+
+    def stats(self):
+        return dict((worker.pid, worker.stats)
+                    for worker in self.workers + self.draining
+                    if worker.stats is not None)
+
+    @tulip.task
+    def replace(self, old):
+        """Fork a replacement for ``old``, then drain it once it serves."""
+        if old.retiring or old not in self.workers:
+            return False
+        old.retiring = True
+        worker = self.spawn()
+        self.workers.append(worker)
+        done, _ = yield from tulip.wait(
+            [worker.ready], timeout=self.args.graceful_timeout)
+        if not done:
+            print('New worker process {} did not start, keep {}'.format(
+                worker.pid, old.pid))
+            if worker in self.workers:
+                self.workers.remove(worker)
+            worker.kill(signal.SIGKILL)
+            old.retiring = False
+            return False
+        self.retire(old)
+        return True
+
+    def retire(self, worker):
+        self.workers.remove(worker)
+        self.draining.append(worker)
+        worker.drain(self.args.graceful_timeout)
+
+    @tulip.task
+    def autoscale(self):
+        """Grow to --max-workers under load, shrink back to --workers."""
+        busy = idle = 0
+        while True:
+            yield from tulip.sleep(self.args.scale_interval)
+            stats = [worker.stats for worker in self.workers
+                     if worker.stats is not None]
+            # a worker replace() is retiring is already gone
+            staying = [worker for worker in self.workers
+                       if not worker.retiring]
+            change, busy, idle = scale_decision(
+                self.args, stats, len(staying), busy, idle)
+            if change > 0:
+                self.workers.append(self.spawn())
+                print('Scale up to {} workers (in flight {:.1f}, lag {:.3f}s)'
+                      .format(len(self.workers), *worker_load(stats)))
+            elif change < 0:
+                # not a replacement replace() waits for, nor one it retires
+                serving = [worker for worker in staying
+                           if worker.ready.done()]
+                if serving:
+                    self.retire(serving[-1])
+                    print('Scale down to {} workers'.format(
+                        len(self.workers)))
+
+    @tulip.task
+    def reload(self):
+        """Rolling restart: replace workers one at a time, draining the old."""
+        print('Reloading {} worker processes'.format(len(self.workers)))
+        for old in list(self.workers):
+            yield from self.replace(old)
+
+
+class AdminServer(tulip.http.ServerHttpProtocol):
+    """Admin endpoint exposing the workers' metrics to Prometheus."""
+
+    def __init__(self, superviser, *args, **kwargs):
+        super(AdminServer, self).__init__(*args, **kwargs)
+        self.superviser = superviser
+
+    def handle_request(self, message, payload):
+        if message.path.split('?', 1)[0] != '/metrics':
+            raise tulip.http.errors.HttpErrorException(404)
+        body = metrics.prometheus(
+            self.superviser.stats(), self.superviser.retired).encode('utf-8')
+        response = tulip.http.Response(self.transport, 200, close=True)
+        response.add_header('Content-type', 'text/plain; version=0.0.4')
+        response.add_header('Content-Length', str(len(body)))
+        response.send_headers()
+        response.write(body)
+        response.write_eof()
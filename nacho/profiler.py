@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+import collections
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+
+def _label(frame):
+    code = frame.f_code
+    return '{}:{}'.format(os.path.basename(code.co_filename), code.co_name)
+
+
+def walk_stack(frame):
+    """Yield ``(frame, obj, handler)`` from ``frame`` out to the stack root.
+
+    ``obj`` is the ``self`` of the frame and ``handler`` the
+    ``module.Class`` of the innermost request handler (an object with
+    ``for_request``) seen so far, or None.
+    """
+    handler = None
+    while frame is not None:
+        obj = frame.f_locals.get('self')
+        if handler is None and hasattr(obj, 'for_request'):
+            handler = '{}.{}'.format(type(obj).__module__,
+                                     type(obj).__name__)
+        yield frame, obj, handler
+        frame = frame.f_back
+
+
+def collapse(frame):
+    """The stack of the profiled request running in ``frame``, collapsed.
+
+    Returns ``route;handler;frame;...`` from the server down to ``frame``,
+    or None when no profiled request is on the stack.
+    """
+    frames = []
+    for frame, obj, handler in walk_stack(frame):
+        frames.append(_label(frame))
+        if getattr(obj, 'profiled', False) and hasattr(obj, 'router'):
+            names = [str(obj.route or '-'), handler or '-']
+            names.extend(reversed(frames))
+            return ';'.join(name.replace(';', ':') for name in names)
+    return None
+
+
+class Profiler(threading.Thread):
+    """Statistical profiler of a fraction of the requests of a worker.
+
+    ``HttpServer`` marks ``rate`` of the requests as profiled. While one of
+    them is in flight, a daemon thread samples the stack of the loop thread
+    every ``interval`` seconds and counts it in collapsed form, tagged with
+    the route regex and handler class, as ``flamegraph.pl`` reads it.
+    """
+
+    def __init__(self, rate=0.01, interval=0.005, directory=None):
+        super(Profiler, self).__init__(name='nacho-profiler', daemon=True)
+        self.rate = rate
+        self.interval = interval
+        self.directory = directory or tempfile.gettempdir()
+        self.active = 0
+        self.stacks = collections.Counter()
+        self.loop_thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start sampling, call from the thread running the event loop."""
+        self.loop_thread = threading.get_ident()
+        super(Profiler, self).start()
+
+    def sample(self):
+        """Whether to profile the request starting now."""
+        return random.random() < self.rate
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self.active:
+                continue
+            frame = sys._current_frames().get(self.loop_thread)
+            stack = frame is not None and collapse(frame)
+            if stack:
+                with self._lock:
+                    self.stacks[stack] += 1
+
+    def collapsed(self):
+        with self._lock:
+            stacks = self.stacks.most_common()
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in stacks)
+
+    def dump(self):
+        """Write the samples so far to ``nacho-<pid>.folded``."""
+        path = os.path.join(self.directory,
+                            'nacho-{}.folded'.format(os.getpid()))
+        with open(path + '.tmp', 'w') as fp:
+            fp.write(self.collapsed())
+        os.rename(path + '.tmp', path)
+        print('Profile of worker process {} written to {}'.format(
+            os.getpid(), path))
+        return path
@@ -1,17 +1,99 @@
 #!/usr/bin/env python3
-from jinja2 import Environment, FileSystemLoader, TemplateNotFound
+from jinja2 import BytecodeCache, Environment, FileSystemLoader, \
+    TemplateNotFound
+
+from nacho import shm
+
+
+# (template_dirs, cache_size, auto_reload, bytecode_cache) -> Environment,
+# per process
+_environments = {}
+
+
+class SharedBytecodeCache(BytecodeCache):
+    """Compiled templates kept in a :class:`nacho.shm.SharedCache`.
+
+    ``shared`` defaults to the superviser's ``shm.cache``, so a template
+    compiled by one worker is loaded by the others instead of recompiled.
+    """
+
+    def __init__(self, shared=None):
+        self._shared = shared
+
+    @property
+    def shared(self):
+        return self._shared if self._shared is not None else shm.cache
+
+    def load_bytecode(self, bucket):
+        shared = self.shared
+        data = shared.get('jinja2:' + bucket.key) if shared else None
+        if data is not None:
+            bucket.bytecode_from_string(data)
+
+    def dump_bytecode(self, bucket):
+        if self.shared is not None:
+            self.shared.set('jinja2:' + bucket.key,
+                            bucket.bytecode_to_string())
+
+    def clear(self):
+        if self.shared is not None:
+            self.shared.clear('jinja2:')
 
 
 class Jinja2Worker(object):
 
-    def __init__(self, template_dirs=['html']):
+    def __init__(self, template_dirs=['html'], cache_size=256,
+                 auto_reload=False, bytecode_cache=None):
         self.template_dirs = template_dirs
+        self.cache_size = cache_size
+        self.auto_reload = auto_reload
+        self.bytecode_cache = bytecode_cache
 
-    def render(self, template_name, *args, **kwargs):
-        env = Environment(loader=FileSystemLoader(self.template_dirs))
+    @property
+    def env(self):
+        key = (tuple(self.template_dirs), self.cache_size, self.auto_reload,
+               self.bytecode_cache)
         try:
-            template = env.get_template(template_name)
+            return _environments[key]
+        except KeyError:
+            env = _environments[key] = Environment(
+                loader=FileSystemLoader(self.template_dirs),
+                cache_size=self.cache_size,
+                auto_reload=self.auto_reload,
+                bytecode_cache=self.bytecode_cache)
+            return env
+
+    def get_template(self, template_name):
+        try:
+            return self.env.get_template(template_name)
         except TemplateNotFound:
             raise TemplateNotFound(template_name)
 
+    def invalidate(self, template_name=None):
+        cache = self.env.cache
+        if cache is None:
+            return
+        if template_name is None:
+            cache.clear()
+            return
+        for key in list(cache.keys()):
+            if key[1] == template_name:
+                del cache[key]
+
+    def prepare(self, template_name):
+        """Return a ``render(**kwargs)`` callable usable from other threads."""
+        template = self.get_template(template_name)
+
+        def render(**kwargs):
+            return template.render(kwargs).encode('utf-8')
+        return render
+
+    def render(self, template_name, *args, **kwargs):
+        template = self.get_template(template_name)
         return template.render(kwargs).encode('utf-8')
+
+    def stream(self, template_name, write, *args, **kwargs):
+        template = self.get_template(template_name)
+        for fragment in template.generate(kwargs):
+            if fragment:
+                write(fragment.encode('utf-8'))
@@ -1,13 +1,72 @@
 #!/usr/bin/env python3
+import os
+
 from quik import FileLoader
 
+from nacho.cache import LRUCache
+
+
+# (template_dirs, cache_size, auto_reload) -> (loader, compiled templates),
+# per process
+_loaders = {}
+
 
 class QuikWorker(object):
 
-    def __init__(self, template_dirs=['html']):
+    def __init__(self, template_dirs=['html'], cache_size=256,
+                 auto_reload=False):
         self.template_dirs = template_dirs
+        self.cache_size = cache_size
+        self.auto_reload = auto_reload
+
+    def _get_loader(self):
+        key = (tuple(self.template_dirs), self.cache_size, self.auto_reload)
+        try:
+            return _loaders[key]
+        except KeyError:
+            loader = _loaders[key] = (FileLoader(self.template_dirs[0]),
+                                      LRUCache(self.cache_size))
+            return loader
+
+    def get_template(self, template_name):
+        loader, cache = self._get_loader()
+        entry = cache.get(template_name)
+        mtime = None
+        if self.auto_reload:
+            mtime = os.path.getmtime(
+                os.path.join(self.template_dirs[0], template_name))
+        if entry is None or entry[1] != mtime:
+            entry = (loader.load_template(template_name), mtime)
+            cache.set(template_name, entry)
+        return entry[0], loader
+
+    def invalidate(self, template_name=None):
+        _, cache = self._get_loader()
+        cache.invalidate(template_name)
+
+    def prepare(self, template_name):
+        """Return a ``render(**kwargs)`` callable usable from other threads."""
+        template, loader = self.get_template(template_name)
+
+        def render(**kwargs):
+            return template.render(kwargs, loader=loader).encode('utf-8')
+        return render
 
     def render(self, template_name, *args, **kwargs):
-        loader = FileLoader(self.template_dirs[0])
-        template = loader.load_template(template_name)
+        template, loader = self.get_template(template_name)
         return template.render(kwargs, loader=loader).encode('utf-8')
+
+    def stream(self, template_name, write, *args, **kwargs):
+        template, loader = self.get_template(template_name)
+        template.merge_to(kwargs, _EncodingWriter(write), loader=loader)
+
+
+class _EncodingWriter(object):
+    """File-like adapter handing encoded fragments to ``write``."""
+
+    def __init__(self, write):
+        self._write = write
+
+    def write(self, data):
+        if data:
+            self._write(data.encode('utf-8'))
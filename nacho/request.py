@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+import cgi
+import http.cookies
+import json
+import tempfile
+from urllib.parse import parse_qsl
+try:
+    from collections.abc import Mapping
+except ImportError:  # pragma: no cover
+    from collections import Mapping
+
+import tulip
+from tulip.http.errors import HttpErrorException
+
+
+_missing = object()
+
+
+class reify(object):
+    """Property computed on first access, then stored on the instance."""
+
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.func.__name__] = self.func(obj)
+        return value
+
+
+class MultiDict(Mapping):
+    """Immutable mapping keeping every value of repeated keys.
+
+    ``d[key]`` and ``d.get(key)`` give the first value and ``d.getall(key)``
+    all of them; ``items()`` lists every pair, in order.
+    """
+
+    def __init__(self, items=()):
+        self._items = []
+        self._index = {}
+        for key, value in items:
+            key = self._key(key)
+            self._items.append((key, value))
+            self._index.setdefault(key, []).append(value)
+
+    @staticmethod
+    def _key(key):
+        return key
+
+    def __getitem__(self, key):
+        return self._index[self._key(key)][0]
+
+    def __contains__(self, key):
+        return self._key(key) in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self._items)
+
+    def getall(self, key, default=()):
+        return list(self._index.get(self._key(key), default))
+
+    def items(self):
+        return list(self._items)
+
+
+class CaseInsensitiveMultiDict(MultiDict):
+
+    @staticmethod
+    def _key(key):
+        return key.upper()
+
+
+class UploadedFile(object):
+    """A file part of a multipart/form-data body.
+
+    ``file`` is a temporary file, in memory until it grows past the
+    request's ``max_memory``, positioned at its start.
+    """
+
+    def __init__(self, name, filename, content_type, file):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.file = file
+        self.size = 0
+
+    def __repr__(self):
+        return '<UploadedFile {!r} {} bytes>'.format(self.filename, self.size)
+
+
+class MultipartParser(object):
+    """Incremental multipart/form-data parser, fed the body chunk by chunk.
+
+    Field values are kept in memory, at most ``max_form_size`` bytes of
+    them in total; file parts are written to :class:`UploadedFile`.
+    """
+
+    max_header_size = 16 * 1024
+
+    def __init__(self, boundary, max_fields=1000, max_form_size=1024 * 1024,
+                 max_memory=1024 * 1024):
+        self.delimiter = b'--' + boundary
+        self.separator = b'\r\n' + self.delimiter
+        self.max_fields = max_fields
+        self.max_form_size = max_form_size
+        self.max_memory = max_memory
+        self.fields = []
+        self.done = False
+        self._buffer = bytearray()
+        self._state = self._preamble
+        self._part = None
+        self._form_size = 0
+
+    def feed(self, data):
+        self._buffer += data
+        while self._state():
+            pass
+
+    def _preamble(self):
+        pos = self._buffer.find(self.delimiter)
+        if pos < 0:
+            # keep what may be the start of the delimiter
+            del self._buffer[:-len(self.delimiter)]
+            return False
+        del self._buffer[:pos + len(self.delimiter)]
+        self._state = self._delimited
+        return True
+
+    def _delimited(self):
+        if len(self._buffer) < 2:
+            return False
+        if self._buffer[:2] == b'--':
+            self.done = True
+            self._state = self._epilogue
+        elif self._buffer[:2] == b'\r\n':
+            self._state = self._headers
+        else:
+            raise HttpErrorException(400, message='Bad multipart delimiter')
+        del self._buffer[:2]
+        return True
+
+    def _headers(self):
+        pos = self._buffer.find(b'\r\n\r\n')
+        if pos < 0:
+            if len(self._buffer) > self.max_header_size:
+                raise HttpErrorException(400, message='Part headers too large')
+            return False
+        lines = bytes(self._buffer[:pos]).decode('utf-8', 'replace')
+        del self._buffer[:pos + 4]
+        self._start_part(lines.split('\r\n') if lines else [])
+        self._state = self._body
+        return True
+
+    def _body(self):
+        pos = self._buffer.find(self.separator)
+        if pos < 0:
+            keep = len(self.separator) - 1
+            if len(self._buffer) > keep:
+                self._write(self._buffer[:-keep])
+                del self._buffer[:-keep]
+            return False
+        self._write(self._buffer[:pos])
+        del self._buffer[:pos + len(self.separator)]
+        self._end_part()
+        self._state = self._delimited
+        return True
+
+    def _epilogue(self):
+        del self._buffer[:]
+        return False
+
+    def _start_part(self, lines):
+        if len(self.fields) >= self.max_fields:
+            raise HttpErrorException(400, message='Too many fields')
+        headers = CaseInsensitiveMultiDict(
+            (name.strip(), value.strip()) for name, _, value in
+            (line.partition(':') for line in lines))
+        _, params = cgi.parse_header(headers.get('Content-Disposition', ''))
+        name = params.get('name', '')
+        if 'filename' in params:
+            self._part = UploadedFile(
+                name, params['filename'],
+                headers.get('Content-Type', 'application/octet-stream'),
+                tempfile.SpooledTemporaryFile(self.max_memory))
+        else:
+            self._part = (name, bytearray())
+
+    def _write(self, data):
+        if not data:
+            return
+        part = self._part
+        if isinstance(part, UploadedFile):
+            part.file.write(data)
+            part.size += len(data)
+            return
+        self._form_size += len(data)
+        if self._form_size > self.max_form_size:
+            raise HttpErrorException(413, message='Form too large')
+        part[1].extend(data)
+
+    def _end_part(self):
+        part, self._part = self._part, None
+        if isinstance(part, UploadedFile):
+            part.file.seek(0)
+            self.fields.append((part.name, part))
+        else:
+            self.fields.append((part[0], part[1].decode('utf-8', 'replace')))
+
+
+class Request(object):
+    """A request message parsed lazily, each part at most once.
+
+    Query, headers and cookies are parsed on first access and the body is
+    only read when :meth:`body`, :meth:`form` or :meth:`json` is called.
+    Other attributes are the message's.
+    """
+
+    # fields of a query or form
+    max_fields = 1000
+    # bytes of body read at all
+    max_body_size = 10 * 1024 * 1024
+    # bytes of urlencoded or JSON body, or of multipart values in memory
+    max_form_size = 1024 * 1024
+    # bytes of an upload kept in memory before spooling it to disk
+    max_memory = 1024 * 1024
+
+    def __init__(self, message, payload=None):
+        self.message = message
+        self.payload = payload
+        self.method = message.method
+        self.path = message.path
+        self.version = message.version
+        self._body = None
+        self._form = None
+        self._json = _missing
+        self._received = 0
+
+    def __getattr__(self, name):
+        return getattr(self.message, name)
+
+    @reify
+    def headers(self):
+        headers = self.message.headers
+        if hasattr(headers, 'items'):
+            headers = headers.items()
+        return CaseInsensitiveMultiDict(headers)
+
+    @reify
+    def query_string(self):
+        return self.path.partition('?')[2].partition('#')[0]
+
+    def _parse_qs(self, qs):
+        if qs.count('&') + qs.count(';') >= self.max_fields:
+            raise HttpErrorException(400, message='Too many fields')
+        return parse_qsl(qs, keep_blank_values=True)
+
+    @reify
+    def args(self):
+        """The query arguments as a :class:`MultiDict`."""
+        return MultiDict(self._parse_qs(self.query_string))
+
+    @reify
+    def query(self):
+        """The query as a dict, repeated arguments as lists."""
+        query = {}
+        for key, value in self.args.items():
+            if value:
+                query.setdefault(key, []).append(value)
+        for key, value in query.items():
+            if len(value) < 2:
+                query[key] = value[0]
+        return query
+
+    @reify
+    def cookies(self):
+        cookie = http.cookies.SimpleCookie()
+        for header in self.headers.getall('Cookie'):
+            try:
+                cookie.load(header)
+            except http.cookies.CookieError:
+                pass
+        return MultiDict((name, morsel.value)
+                         for name, morsel in cookie.items())
+
+    @reify
+    def content_type(self):
+        """The Content-Type as ``(type, params)``."""
+        ctype, params = cgi.parse_header(self.headers.get('Content-Type', ''))
+        return ctype.lower(), params
+
+    @reify
+    def content_length(self):
+        try:
+            return int(self.headers['Content-Length'])
+        except (KeyError, ValueError):
+            return None
+
+    def check_length(self, limit=None):
+        """Answer 413 if the announced Content-Length is over ``limit``."""
+        limit = limit or self.max_body_size
+        if self.content_length is not None and self.content_length > limit:
+            raise HttpErrorException(413, message='Request body too large')
+
+    @tulip.coroutine
+    def read_chunk(self):
+        """The next chunk of the body, ``b''`` once it is all read.
+
+        Reading chunk by chunk keeps at most a few of them in memory: the
+        connection stops reading from its socket while the handler does
+        not keep up. Past ``max_body_size`` bytes the answer is a 413.
+        """
+        chunk = yield from self.payload.read()
+        if not chunk:
+            return b''
+        self._received += len(chunk)
+        if self._received > self.max_body_size:
+            raise HttpErrorException(413, message='Request body too large')
+        return chunk
+
+    @tulip.coroutine
+    def body(self, limit=None):
+        """The whole body, answering 413 past ``limit`` bytes."""
+        if self._body is None:
+            limit = min(limit or self.max_body_size, self.max_body_size)
+            self.check_length(limit)
+            chunks, size = [], 0
+            while True:
+                chunk = yield from self.read_chunk()
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > limit:
+                    raise HttpErrorException(
+                        413, message='Request body too large')
+                chunks.append(chunk)
+            self._body = b''.join(chunks)
+        return self._body
+
+    @tulip.coroutine
+    def pipe(self, write):
+        """Pass each chunk of the body to ``write``, returning the size.
+
+        ``write`` may return a coroutine or future (e.g. a writer's drain),
+        which is waited for before the next chunk is read, so a slow
+        destination slows down the upload instead of filling memory.
+        """
+        size = 0
+        while True:
+            chunk = yield from self.read_chunk()
+            if not chunk:
+                return size
+            size += len(chunk)
+            result = write(chunk)
+            if tulip.iscoroutine(result) or isinstance(result, tulip.Future):
+                yield from result
+
+    @tulip.coroutine
+    def save(self, file, executor=None):
+        """Write the body to ``file``, a path or binary file object.
+
+        Writes run in ``executor`` (the loop's default one when None) so
+        disk I/O does not block the event loop.
+        """
+        loop = tulip.get_event_loop()
+        fp = file
+        if isinstance(file, str):
+            fp = yield from loop.run_in_executor(executor, open, file, 'wb')
+        try:
+            return (yield from self.pipe(
+                lambda chunk: loop.run_in_executor(executor, fp.write, chunk)))
+        finally:
+            if fp is not file:
+                yield from loop.run_in_executor(executor, fp.close)
+
+    @tulip.coroutine
+    def form(self):
+        """The urlencoded or multipart form fields as a :class:`MultiDict`.
+
+        Uploaded files are :class:`UploadedFile` values.
+        """
+        if self._form is None:
+            ctype, params = self.content_type
+            if ctype == 'multipart/form-data':
+                fields = yield from self._multipart(params.get('boundary'))
+            elif ctype == 'application/x-www-form-urlencoded':
+                body = yield from self.body(self.max_form_size)
+                fields = self._parse_qs(body.decode('utf-8', 'replace'))
+            else:
+                fields = ()
+            self._form = MultiDict(fields)
+        return self._form
+
+    @tulip.coroutine
+    def _multipart(self, boundary):
+        if not boundary:
+            raise HttpErrorException(400, message='Missing boundary')
+        self.check_length()
+        parser = MultipartParser(
+            boundary.encode('latin-1'), self.max_fields, self.max_form_size,
+            self.max_memory)
+        while True:
+            chunk = yield from self.read_chunk()
+            if not chunk:
+                break
+            parser.feed(chunk)
+        if not parser.done:
+            raise HttpErrorException(400, message='Truncated multipart body')
+        return parser.fields
+
+    @tulip.coroutine
+    def json(self):
+        if self._json is _missing:
+            body = yield from self.body(self.max_form_size)
+            try:
+                self._json = json.loads(body.decode('utf-8'))
+            except ValueError:
+                raise HttpErrorException(400, message='Invalid JSON body')
+        return self._json
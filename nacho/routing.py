@@ -1,19 +1,116 @@
 import re
-import collections
+try:
+    from collections.abc import Iterable
+except ImportError:  # pragma: no cover
+    from collections import Iterable
+
+from nacho.cache import LRUCache
+from nacho.middleware import Pipeline
+
+
+_METACHARS = frozenset('.^$*+?{}[]\\|()')
+_QUANTIFIERS = frozenset('*+?{')
+
+
+def _literal_prefix(pattern):
+    """Return the literal text every match of ``pattern`` starts with."""
+    if '|' in pattern:
+        return ''
+    for pos, char in enumerate(pattern):
+        if char in _METACHARS:
+            if char in _QUANTIFIERS:
+                pos -= 1
+            return pattern[:max(pos, 0)]
+    return pattern
+
 
 class Router(object):
-    def __init__(self, handlers=None):
+    """URL dispatcher.
+
+    Routes are tried in registration order and the first one whose regex
+    matches the start of the url wins. Lookups go through a compiled table:
+    every route is indexed by the literal prefix of its regex, so only the
+    routes that can possibly match are tried, and recent results are kept
+    in a bounded LRU.
+
+    The handlers of each route run as a :class:`~nacho.middleware.Pipeline`
+    with the router's ``middleware`` then the route's composed around them.
+    The chains are composed by :meth:`compile`, which runs again after
+    :meth:`add_handler`; call it after changing ``middleware`` alone.
+    """
+
+    def __init__(self, handlers=None, cache_size=1024, middleware=()):
         self.handlers = handlers or []
+        self.cache = LRUCache(cache_size)
+        self.middleware = list(middleware)
+        self._compiled = False
 
-    def add_handler(self, url_regex, handlers):
+    def add_handler(self, url_regex, handlers, middleware=()):
+        if not isinstance(handlers, Iterable):
+            handlers = [handlers]
         self.handlers.append(
-            (re.compile(url_regex), 
-             handlers if isinstance(handlers, collections.Iterable) 
-             else [handlers]))
+            (re.compile(url_regex), Pipeline(handlers, middleware)))
+        self._compiled = False
 
-    def get_handler(self, url):
-        for matcher, handler in self.handlers:
-            match = matcher.match(url)
-            if match:
-                return handler, match.groups()
+    def compile(self):
+        # literal prefix -> route indexes, bucketed by prefix length
+        prefixes = {}
+        routes = []
+        for idx, (matcher, handlers) in enumerate(self.handlers):
+            if not isinstance(handlers, Pipeline):
+                handlers = Pipeline(handlers)
+                self.handlers[idx] = (matcher, handlers)
+            # router middleware added since the route was, applies to it too
+            handlers.compose(self.middleware)
+            pattern = matcher.pattern
+            if not isinstance(pattern, str) or matcher.flags & ~re.UNICODE:
+                prefix = ''
+            else:
+                prefix = _literal_prefix(pattern)
+            literal = prefix == pattern
+            bucket = prefixes.setdefault(len(prefix), {})
+            bucket.setdefault(prefix, []).append(idx)
+            routes.append((None if literal else matcher.match, handlers))
+        self._prefixes = sorted(prefixes.items())
+        self._routes = routes
+        self.cache.clear()
+        self._compiled = True
+
+    def _lookup(self, url):
+        candidates = []
+        size = len(url)
+        for length, bucket in self._prefixes:
+            if length > size:
+                break
+            indexes = bucket.get(url[:length])
+            if indexes:
+                candidates.extend(indexes)
+        candidates.sort()
+
+        routes = self._routes
+        for idx in candidates:
+            match = routes[idx][0]
+            if match is None:
+                return idx, ()
+            found = match(url)
+            if found:
+                return idx, found.groups()
         return None, None
+
+    def get_handler(self, url):
+        if not self._compiled:
+            self.compile()
+        result = self.cache.get(url)
+        if result is None:
+            idx, args = self._lookup(url)
+            result = (None, None) if idx is None else \
+                (self._routes[idx][1], args)
+            self.cache.set(url, result)
+        return result
+
+    def get_route(self, url):
+        """The regex of the route ``url`` dispatches to, or None."""
+        if not self._compiled:
+            self.compile()
+        idx, _ = self._lookup(url)
+        return None if idx is None else self.handlers[idx][0].pattern
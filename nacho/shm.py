@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+import hashlib
+import logging
+import mmap
+import multiprocessing
+import struct
+import time
+
+
+# key hash (0 for an empty slot), expires (0 for never), last used,
+# key length, value length
+_HEADER = struct.Struct('=QddII')
+
+
+class SharedCache(object):
+    """Byte cache in anonymous shared memory, shared by forked workers.
+
+    Create it before forking. ``size`` bytes are split into fixed slots of
+    ``slot_size`` bytes, grouped into sets of ``ways`` slots: a key can
+    only live in the set its hash picks, and a full set evicts the least
+    recently used or an expired slot. Each set is guarded by one of
+    ``stripes`` process-shared locks. Values too large for a slot are not
+    stored.
+
+    A lock is waited for at most ``lock_timeout`` seconds, then the call
+    gives up as a miss or a skipped store: a worker killed while holding
+    one never releases it, and the others must not hang on it.
+    """
+
+    def __init__(self, size=64 * 1024 * 1024, slot_size=64 * 1024, ways=8,
+                 stripes=64, lock_timeout=0.01):
+        self.slot_size = slot_size
+        self.lock_timeout = lock_timeout
+        self.ways = ways
+        self.sets = max(size // (slot_size * ways), 1)
+        self.slots = self.sets * ways
+        self.map = mmap.mmap(-1, self.slots * slot_size)
+        self.locks = [multiprocessing.Lock()
+                      for _ in range(min(stripes, self.sets))]
+
+    def __len__(self):
+        count = 0
+        for slot in range(self.slots):
+            if _HEADER.unpack_from(self.map, slot * self.slot_size)[0]:
+                count += 1
+        return count
+
+    def _hash(self, key):
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        digest = int.from_bytes(hashlib.md5(key).digest()[:8], 'little')
+        return digest or 1, key
+
+    def _find(self, digest, key, now):
+        """Offset of the live slot holding ``key`` in its set, or None."""
+        start = digest % self.sets * self.ways
+        for slot in range(start, start + self.ways):
+            offset = slot * self.slot_size
+            slot_hash, expires, _, key_len, _ = _HEADER.unpack_from(
+                self.map, offset)
+            if slot_hash != digest or key_len != len(key):
+                continue
+            pos = offset + _HEADER.size
+            if self.map[pos:pos + key_len] != key:
+                continue
+            if expires and expires <= now:
+                _HEADER.pack_into(self.map, offset, 0, 0.0, 0.0, 0, 0)
+                return None
+            return offset
+        return None
+
+    def _acquire(self, lock):
+        if lock.acquire(timeout=self.lock_timeout):
+            return True
+        logging.warning('Shared cache lock busy for %.3fs, skipped',
+                        self.lock_timeout)
+        return False
+
+    def _lock(self, digest):
+        return self.locks[digest % self.sets % len(self.locks)]
+
+    def get(self, key, default=None):
+        digest, key = self._hash(key)
+        now = time.monotonic()
+        lock = self._lock(digest)
+        if not self._acquire(lock):
+            return default
+        try:
+            offset = self._find(digest, key, now)
+            if offset is None:
+                return default
+            _, expires, _, key_len, value_len = _HEADER.unpack_from(
+                self.map, offset)
+            _HEADER.pack_into(self.map, offset, digest, expires, now,
+                              key_len, value_len)
+            pos = offset + _HEADER.size + key_len
+            return self.map[pos:pos + value_len]
+        finally:
+            lock.release()
+
+    def set(self, key, value, ttl=None):
+        """Store ``value``, returning False when it was not stored."""
+        digest, key = self._hash(key)
+        if _HEADER.size + len(key) + len(value) > self.slot_size:
+            return False
+        now = time.monotonic()
+        expires = now + ttl if ttl else 0.0
+        lock = self._lock(digest)
+        if not self._acquire(lock):
+            return False
+        try:
+            offset = self._find(digest, key, now)
+            if offset is None:
+                offset = self._victim(digest, now)
+            _HEADER.pack_into(self.map, offset, 0, 0.0, 0.0, 0, 0)
+            pos = offset + _HEADER.size
+            self.map[pos:pos + len(key)] = key
+            pos += len(key)
+            self.map[pos:pos + len(value)] = value
+            _HEADER.pack_into(self.map, offset, digest, expires, now,
+                              len(key), len(value))
+        finally:
+            lock.release()
+        return True
+
+    def _victim(self, digest, now):
+        """Offset of an empty, expired or else least recently used slot."""
+        start = digest % self.sets * self.ways
+        victim, oldest = None, None
+        for slot in range(start, start + self.ways):
+            offset = slot * self.slot_size
+            slot_hash, expires, used, _, _ = _HEADER.unpack_from(
+                self.map, offset)
+            if not slot_hash or (expires and expires <= now):
+                return offset
+            if oldest is None or used < oldest:
+                victim, oldest = offset, used
+        return victim
+
+    def delete(self, key):
+        digest, key = self._hash(key)
+        lock = self._lock(digest)
+        if not self._acquire(lock):
+            return
+        try:
+            offset = self._find(digest, key, time.monotonic())
+            if offset is not None:
+                _HEADER.pack_into(self.map, offset, 0, 0.0, 0.0, 0, 0)
+        finally:
+            lock.release()
+
+    def clear(self, prefix=None):
+        """Empty the cache, or only the keys starting with ``prefix``.
+
+        Every user of the cache keys its entries with a prefix of its own
+        (``response:``, ``gzip:``, ``jinja2:``) and clears only that one.
+        """
+        if isinstance(prefix, str):
+            prefix = prefix.encode('utf-8')
+        for slot in range(self.slots):
+            offset = slot * self.slot_size
+            lock = self.locks[slot // self.ways % len(self.locks)]
+            if not self._acquire(lock):
+                continue
+            try:
+                if prefix is not None:
+                    _, _, _, key_len, _ = _HEADER.unpack_from(
+                        self.map, offset)
+                    pos = offset + _HEADER.size
+                    if key_len < len(prefix) or \
+                            self.map[pos:pos + len(prefix)] != prefix:
+                        continue
+                _HEADER.pack_into(self.map, offset, 0, 0.0, 0.0, 0, 0)
+            finally:
+                lock.release()
+
+
+# created by the superviser before forking, see --shared-cache
+cache = None
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+import email.utils
+import gzip
+import mimetypes
+import os
+import socket
+import stat
+import time
+import uuid
+
+import tulip
+try:
+    import ssl
+except ImportError:  # pragma: no cover
+    ssl = None
+
+from nacho.cache import LRUCache
+from nacho import compression, shm
+from nacho.metrics import metrics
+
+
+READ_CHUNK_SIZE = 64 * 1024
+# larger range sets are served as a plain 200
+MAX_RANGES = 16
+
+
+class OpenFile(object):
+    """Cached open descriptor plus the stat result it was opened with."""
+
+    def __init__(self, path, fd, stat_result):
+        self.path = path
+        self.fd = fd
+        self.stat = stat_result
+        self.checked = time.monotonic()
+        self._refs = 0
+        self._closed = False
+
+    @property
+    def size(self):
+        return self.stat.st_size
+
+    @property
+    def mtime(self):
+        return self.stat.st_mtime
+
+    @property
+    def etag(self):
+        return '"{:x}-{:x}"'.format(int(self.mtime * 1000000), self.size)
+
+    @property
+    def last_modified(self):
+        return email.utils.formatdate(self.mtime, usegmt=True)
+
+    def acquire(self):
+        self._refs += 1
+        return self
+
+    def release(self):
+        self._refs -= 1
+        if self._closed and not self._refs:
+            os.close(self.fd)
+
+    def close(self):
+        # in-flight transfers keep the descriptor until they release it
+        if not self._closed:
+            self._closed = True
+            if not self._refs:
+                os.close(self.fd)
+
+
+class FileCache(object):
+    """LRU of open file descriptors and stat results.
+
+    Entries are re-validated with ``os.stat`` at most every ``stat_ttl``
+    seconds and reopened when the file on disk changed.
+    """
+
+    def __init__(self, maxsize=256, stat_ttl=1.0):
+        self.stat_ttl = stat_ttl
+        self.entries = LRUCache(
+            maxsize, on_evict=lambda path, entry: entry.close())
+        # path -> time it was found missing, so misses are not retried
+        # on every request
+        self.missing = LRUCache(maxsize)
+
+    def _fresh(self, entry):
+        if time.monotonic() - entry.checked < self.stat_ttl:
+            return True
+        try:
+            st = os.stat(entry.path)
+        except OSError:
+            return False
+        if (st.st_ino, st.st_size, st.st_mtime) != \
+                (entry.stat.st_ino, entry.size, entry.mtime):
+            return False
+        entry.checked = time.monotonic()
+        return True
+
+    def get(self, path):
+        """Return a cached :class:`OpenFile` or None; never blocks on miss."""
+        entry = self.entries.get(path)
+        if entry is not None and not self._fresh(entry):
+            self.entries.invalidate(path)
+            entry = None
+        return entry
+
+    def add(self, entry):
+        self.missing.invalidate(entry.path)
+        self.entries.invalidate(entry.path)
+        self.entries.set(entry.path, entry)
+        return entry
+
+    def is_missing(self, path):
+        checked = self.missing.get(path)
+        return checked is not None and \
+            time.monotonic() - checked < self.stat_ttl
+
+    def add_missing(self, path):
+        self.missing.set(path, time.monotonic())
+
+    def clear(self):
+        self.entries.clear()
+        self.missing.clear()
+
+
+class CompressedCache(object):
+    """Gzipped copies of compressible files, bounded in bytes.
+
+    Keyed by path and mtime, so a hot asset is compressed once per worker,
+    or once for all of them when a :class:`nacho.shm.SharedCache` is given
+    (``shared``, else ``shm.cache``). Concurrent misses for the same file
+    share one compression.
+    """
+
+    def __init__(self, maxbytes=16 * 1024 * 1024, level=6, shared=None):
+        self.level = level
+        self.entries = LRUCache(maxbytes, weigh=len)
+        self._shared = shared
+        self._pending = {}
+
+    @property
+    def shared(self):
+        return self._shared if self._shared is not None else shm.cache
+
+    def _compress(self, fd, size):
+        return gzip.compress(os.pread(fd, size, 0), self.level)
+
+    @tulip.coroutine
+    def get(self, loop, entry):
+        """Return the gzipped body of ``entry``, or None when not smaller."""
+        key = (entry.path, entry.mtime, entry.size)
+        data = self.entries.get(key)
+        shared = self.shared
+        if data is None and shared is not None:
+            data = shared.get('gzip:{}:{}:{}'.format(*key))
+        if data is not None:
+            return data or None
+        pending = self._pending.get(key)
+        if pending is not None:
+            data = yield from pending
+            return data or None
+
+        future = self._pending[key] = tulip.Future()
+        entry.acquire()
+        try:
+            data = yield from loop.run_in_executor(
+                None, self._compress, entry.fd, entry.size)
+        except Exception as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            if len(data) >= entry.size:
+                data = b''
+            if shared is None or not shared.set(
+                    'gzip:{}:{}:{}'.format(*key), data):
+                self.entries.set(key, data)
+            future.set_result(data)
+        finally:
+            entry.release()
+            del self._pending[key]
+        return data or None
+
+    def clear(self):
+        self.entries.clear()
+
+
+# shared by every StaticFile in the process
+file_cache = FileCache()
+compressed_cache = CompressedCache()
+
+
+def open_file(path):
+    """Open ``path`` for a :class:`FileCache`, raising OSError if unusable.
+
+    This does blocking disk I/O, run it in an executor.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode):
+            raise IsADirectoryError(path)
+    except OSError:
+        os.close(fd)
+        raise
+    return OpenFile(path, fd, st)
+
+
+def sendfile_socket(transport):
+    """Return the plain socket behind ``transport`` when sendfile is usable.
+
+    Returns None under SSL, for non-socket transports or when the transport
+    still has buffered data that would be overtaken by the raw writes.
+    """
+    if not hasattr(os, 'sendfile'):
+        return None
+    sock = transport.get_extra_info('socket')
+    if not isinstance(sock, socket.socket):
+        return None
+    if ssl is not None and isinstance(sock, ssl.SSLSocket):
+        return None
+    if getattr(transport, '_buffer', None):
+        return None
+    return sock
+
+
+def sendfile(loop, sock, fd, offset, count):
+    """Send ``count`` bytes of ``fd`` with os.sendfile as the socket drains.
+
+    Returns a future resolved with the number of bytes sent.
+    """
+    future = tulip.Future()
+    fileno = sock.fileno()
+    total = count
+
+    def send():
+        nonlocal offset, count
+        try:
+            sent = os.sendfile(fileno, fd, offset, count)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            loop.remove_writer(fileno)
+            if not future.cancelled():
+                future.set_exception(exc)
+            return
+        offset += sent
+        count -= sent
+        metrics.bytes_out += sent
+        if not sent or count <= 0:
+            loop.remove_writer(fileno)
+            if not future.cancelled():
+                future.set_result(total - count)
+
+    def done(future):
+        if future.cancelled():
+            loop.remove_writer(fileno)
+
+    future.add_done_callback(done)
+    loop.add_writer(fileno, send)
+    return future
+
+
+@tulip.coroutine
+def read_into(loop, response, fd, offset, count, chunk_size=READ_CHUNK_SIZE):
+    """Copy a file range into ``response`` reading it in an executor."""
+    while count > 0:
+        chunk = yield from loop.run_in_executor(
+            None, os.pread, fd, min(chunk_size, count), offset)
+        if not chunk:
+            break
+        response.write(chunk)
+        offset += len(chunk)
+        count -= len(chunk)
+
+
+def _parse_date(value):
+    try:
+        return email.utils.mktime_tz(email.utils.parsedate_tz(value))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def _etag_matches(etag, header):
+    if header.strip() == '*':
+        return True
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def not_modified(etag, mtime, if_none_match=None, if_modified_since=None):
+    """Whether a conditional GET can be answered with 304."""
+    if if_none_match is not None:
+        return _etag_matches(etag, if_none_match)
+    if if_modified_since is not None:
+        since = _parse_date(if_modified_since)
+        return since is not None and int(mtime) <= since
+    return False
+
+
+def if_range_matches(entry, if_range=None):
+    """Whether a Range request may be honored given its If-Range header."""
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        return if_range == entry.etag
+    since = _parse_date(if_range)
+    return since is not None and int(entry.mtime) <= since
+
+
+def parse_range(header, size):
+    """Parse a Range header into a list of inclusive ``(start, end)`` pairs.
+
+    Returns None when the header should be ignored (syntax we do not
+    understand, too many ranges) and an empty list when no range is
+    satisfiable.
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        first, sep, last = spec.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if not first:
+                length = int(last)
+                if length > 0 and size:
+                    ranges.append((max(size - length, 0), size - 1))
+                continue
+            start = int(first)
+            end = int(last) if last else None
+        except ValueError:
+            return None
+        if end is None:
+            end = size - 1
+        elif start > end:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def content_range(start, end, size):
+    return 'bytes {}-{}/{}'.format(start, end, size)
+
+
+class MultipartRanges(object):
+    """Layout of a ``multipart/byteranges`` body for several ranges."""
+
+    def __init__(self, ranges, size, content_type):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/byteranges; boundary=' + self.boundary
+        self.parts = []
+        for start, end in ranges:
+            head = ('\r\n--{}\r\nContent-Type: {}\r\n'
+                    'Content-Range: {}\r\n\r\n').format(
+                self.boundary, content_type, content_range(start, end, size))
+            self.parts.append((head.encode('ascii'), start, end))
+        self.tail = '\r\n--{}--\r\n'.format(self.boundary).encode('ascii')
+
+    @property
+    def length(self):
+        return sum(len(head) + end - start + 1
+                   for head, start, end in self.parts) + len(self.tail)
+
+
+def precompress(root, min_size=256, level=9, types=compression.COMPRESSIBLE_TYPES):
+    """Write a ``.gz`` sibling for every compressible file under ``root``.
+
+    Siblings that are up to date are kept; files that do not shrink are
+    skipped. Yields ``(path, size, compressed_size)`` for each file written.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        for name in filenames:
+            if name.startswith('.') or name.endswith('.gz'):
+                continue
+            path = os.path.join(dirpath, name)
+            content_type = mimetypes.guess_type(path)[0]
+            if not compression.is_compressible(content_type, types):
+                continue
+            st = os.stat(path)
+            if st.st_size < min_size:
+                continue
+            target = path + '.gz'
+            try:
+                if os.stat(target).st_mtime >= st.st_mtime:
+                    continue
+            except FileNotFoundError:
+                pass
+            with open(path, 'rb') as fp:
+                data = gzip.compress(fp.read(), level)
+            if len(data) >= st.st_size:
+                continue
+            with open(target, 'wb') as fp:
+                fp.write(data)
+            os.utime(target, (st.st_atime, st.st_mtime))
+            yield path, st.st_size, len(data)
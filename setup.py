@@ -13,5 +13,5 @@ setup(name='nacho',
     license=nacho.__license__,
     packages=find_packages(exclude=('doc', 'docs', 'example')),
     package_dir={'nacho': 'nacho'},
-    #scripts=['nacho/bin/nacho'],
+    scripts=['nacho/bin/nacho'],
     include_package_data=True)
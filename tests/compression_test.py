@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+import unittest
+
+from nacho import compression
+
+
+class CompressionTest(unittest.TestCase):
+
+    def test_parse_accept_encoding(self):
+        self.assertEqual(
+            compression.parse_accept_encoding('gzip;q=0.5, deflate, br;q=x'),
+            {'gzip': 0.5, 'deflate': 1.0, 'br': 0.0})
+        self.assertEqual(compression.parse_accept_encoding(None), {})
+
+    def test_negotiate(self):
+        self.assertEqual(compression.negotiate('gzip, deflate'), 'gzip')
+        self.assertEqual(compression.negotiate('gzip;q=0.5, deflate'),
+                         'deflate')
+        self.assertEqual(compression.negotiate('*'), 'gzip')
+        self.assertIsNone(compression.negotiate(''))
+        self.assertIsNone(compression.negotiate('gzip;q=0, br'))
+        self.assertIsNone(compression.negotiate('gzip;q=0.5, identity'))
+        self.assertEqual(compression.negotiate('gzip, identity;q=0'), 'gzip')
+
+    def test_is_compressible(self):
+        self.assertTrue(compression.is_compressible('text/html; charset=utf8'))
+        self.assertTrue(compression.is_compressible('application/json'))
+        self.assertFalse(compression.is_compressible('image/png'))
+        self.assertFalse(compression.is_compressible('application/json',
+                                                     types=()))
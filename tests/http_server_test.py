@@ -1,21 +1,36 @@
 #!/usr/bin/env python3
+import gzip
+import json
+import os
 import unittest
 import unittest.mock
 import re
+import tempfile
+import time
 
 import tulip
 from tulip.http import server, errors
 from tulip.test_utils import run_briefly
+from nacho import executor, http
+from nacho.app import Application, StaticFile
+from nacho.cache import CachedResponse, ResponseCache, cached
+from nacho.executor import blocking
 from nacho.http import HttpServer
+from nacho.metrics import CountingTransport
+from nacho.middleware import Middleware
 from nacho.routing import Router
+from nacho.shm import SharedCache
 
 
 class MockHttpServer(HttpServer):
     """Wrap server class with mocking support
     """
     def handle_error(self, *args, **kwargs):
-        if self.transport.__class__.__name__ == 'Mock':
-            self.transport.reset_mock()
+        transport = self.transport
+        if isinstance(transport, CountingTransport):
+            transport = transport.transport
+        if isinstance(transport, unittest.mock.Mock):
+            transport.reset_mock()
         super(HttpServer, self).handle_error(*args, **kwargs)
 
 
@@ -69,6 +84,605 @@ class HttpServerTest(unittest.TestCase):
         self.assertEqual(content, testcontent)
         transport = None
 
+    def _request(self, router, request):
+        transport = unittest.mock.Mock()
+        srv = MockHttpServer(router)
+        srv.connection_made(transport)
+        srv.stream.feed_data(request)
+        self.loop.run_until_complete(srv._request_handler)
+        return b''.join([c[1][0] for c in list(transport.write.mock_calls)])
+
+    def test_small_body_content_length(self):
+        class Hello(Application):
+            def get(self):
+                self.response.write(b'hello')
+
+        router = Router()
+        router.add_handler('/', Hello())
+        content = self._request(
+            router, b'GET / HTTP/1.1\r\n'
+                    b'Accept-Encoding: gzip\r\n'
+                    b'Host: example.com\r\n\r\n')
+        headers, body = content.split(b'\r\n\r\n', 1)
+        self.assertIn(b'CONTENT-LENGTH: 5', headers.upper())
+        self.assertNotIn(b'CONTENT-ENCODING', headers.upper())
+        self.assertEqual(body, b'hello')
+
+    def test_large_body_compressed(self):
+        class Page(Application):
+            def get(self):
+                self.response.write(b'nacho ' * 1000)
+
+        router = Router()
+        router.add_handler('/', Page())
+        content = self._request(
+            router, b'GET / HTTP/1.1\r\n'
+                    b'Accept-Encoding: deflate;q=0.5, gzip\r\n'
+                    b'Host: example.com\r\n\r\n')
+        headers = content.split(b'\r\n\r\n', 1)[0].upper()
+        self.assertIn(b'CONTENT-ENCODING: GZIP', headers)
+        self.assertIn(b'TRANSFER-ENCODING: CHUNKED', headers)
+
+    def test_chunked_writes_coalesced(self):
+        class Page(Application):
+            chunk_size = 4096
+
+            def get(self):
+                for _ in range(1000):
+                    self.response.write(b'<li>item</li>\n')
+
+        router = Router()
+        router.add_handler('/', Page())
+        transport = unittest.mock.Mock()
+        srv = MockHttpServer(router)
+        srv.connection_made(transport)
+        srv.stream.feed_data(b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+        self.loop.run_until_complete(srv._request_handler)
+
+        # 14000 bytes in chunks of at least 4096, headers with the first
+        # and the last chunk with the terminator
+        writes = [c[1][0] for c in transport.write.mock_calls]
+        self.assertEqual(len(writes), 4)
+        headers, rest = b''.join(writes).split(b'\r\n\r\n', 1)
+        self.assertIn(b'TRANSFER-ENCODING: CHUNKED', headers.upper())
+        body = b''
+        while True:
+            size, rest = rest.split(b'\r\n', 1)
+            size = int(size, 16)
+            if not size:
+                break
+            body, rest = body + rest[:size], rest[size + 2:]
+        self.assertEqual(rest, b'\r\n')
+        self.assertEqual(body, b'<li>item</li>\n' * 1000)
+
+    def test_keep_alive_pipelined(self):
+        class Echo(Application):
+            def get(self, request_args=None):
+                self.response.write(self.request.path.encode('ascii'))
+
+        router = Router()
+        router.add_handler('/', Echo())
+        transport = unittest.mock.Mock()
+        srv = MockHttpServer(router, keep_alive=75, max_requests=2)
+        srv.connection_made(transport)
+        srv.stream.feed_data(
+            b'GET /first HTTP/1.1\r\nHost: example.com\r\n\r\n'
+            b'GET /second HTTP/1.1\r\nHost: example.com\r\n\r\n'
+            b'GET /third HTTP/1.1\r\nHost: example.com\r\n\r\n')
+        self.loop.run_until_complete(srv._request_handler)
+
+        content = b''.join([c[1][0] for c in list(transport.write.mock_calls)])
+        first, second = content.split(b'HTTP/1.1 200 OK\r\n')[1:]
+        self.assertIn(b'CONNECTION: KEEP-ALIVE', first.upper())
+        self.assertTrue(first.endswith(b'/first'))
+        # max_requests reached, the third request is never answered
+        self.assertIn(b'CONNECTION: CLOSE', second.upper())
+        self.assertTrue(second.endswith(b'/second'))
+        self.assertTrue(transport.close.called)
+
+    def test_drain_closes_idle_connections(self):
+        router = Router()
+        router.add_handler('/', Application())
+        idle, reading = unittest.mock.Mock(), unittest.mock.Mock()
+        idle_srv = MockHttpServer(router, keep_alive=75)
+        idle_srv.connection_made(idle)
+        reading_srv = MockHttpServer(router, keep_alive=75)
+        reading_srv.connection_made(reading)
+        reading_srv.data_received(b'GET / HTTP/1.1\r\nHost: exa')
+        self.addCleanup(setattr, http, 'draining', False)
+        self.addCleanup(http.connections.clear)
+
+        http.drain_connections()
+        self.assertTrue(idle.close.called)
+        # part of a request was read, it is answered before closing
+        self.assertFalse(reading.close.called)
+
+    def test_drain_keeps_pipelined_partial(self):
+        router = Router()
+        router.add_handler('/', Application())
+        transport = unittest.mock.Mock()
+        srv = MockHttpServer(router, keep_alive=75)
+        srv.connection_made(transport)
+        self.addCleanup(setattr, http, 'draining', False)
+        self.addCleanup(http.connections.clear)
+        srv.data_received(b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n'
+                          b'GET / HTTP/1.1\r\nHo')
+        while not transport.write.called:
+            run_briefly(self.loop)
+        run_briefly(self.loop)
+
+        # the first request is answered, part of the next one is buffered
+        self.assertFalse(srv.idle)
+        http.drain_connections()
+        self.assertFalse(transport.close.called)
+        srv._request_handler.cancel()
+
+    def test_keep_alive_http10(self):
+        router = Router()
+        router.add_handler('/', Application())
+        transport = unittest.mock.Mock()
+        srv = MockHttpServer(router, keep_alive=75)
+        srv.connection_made(transport)
+        srv.stream.feed_data(
+            b'GET / HTTP/1.0\r\nConnection: keep-alive\r\n\r\n')
+        srv.eof_received()
+        self.loop.run_until_complete(srv._request_handler)
+
+        content = b''.join([c[1][0] for c in list(transport.write.mock_calls)])
+        headers, body = content.split(b'\r\n\r\n', 1)
+        self.assertIn(b'CONNECTION: KEEP-ALIVE', headers.upper())
+        self.assertNotIn(b'TRANSFER-ENCODING', headers.upper())
+        self.assertEqual(body, b'nacho: base handler')
+
+    def test_handler_per_request(self):
+        class Counter(Application):
+            hits = []
+
+            def get(self, request_args=None):
+                self.hits.append(self)
+                self.response.write(b'ok')
+
+        handler = Counter()
+        router = Router()
+        router.add_handler('/', handler)
+        for _ in range(2):
+            self._request(router, b'GET / HTTP/1.1\r\n'
+                                  b'Host: example.com\r\n\r\n')
+        first, second = Counter.hits
+        self.assertIsNot(first, second)
+        self.assertIsNot(first, handler)
+        self.assertIs(first.renderer, handler.renderer)
+        self.assertIsNone(handler.response)
+
+    def test_coroutine_handler(self):
+        class Slow(Application):
+            @tulip.coroutine
+            def get(self):
+                yield from tulip.sleep(0.01)
+                self.response.write(b'slow')
+
+        router = Router()
+        router.add_handler('/', Slow())
+        content = self._request(
+            router, b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+        self.assertTrue(content.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(content.endswith(b'slow'))
+
+    def test_coroutine_handlers_chain(self):
+        calls = []
+
+        class First(Application):
+            @tulip.coroutine
+            def get(self):
+                yield from tulip.sleep(0.01)
+                calls.append('first')
+                self.response.write(b'first ')
+
+        class Second(Application):
+            def __init__(self):
+                super(Second, self).__init__(write_headers=False)
+
+            def get(self):
+                calls.append('second')
+                self.response = self.prev_response
+                self.response.write(b'second')
+
+        router = Router()
+        router.add_handler('/', [First(), Second()])
+        content = self._request(
+            router, b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+        self.assertEqual(calls, ['first', 'second'])
+        self.assertTrue(content.endswith(b'first second'))
+
+    def test_middleware(self):
+        calls = []
+
+        class Auth(Middleware):
+            def before(self, handler):
+                calls.append('auth')
+                if 'token' not in handler.query:
+                    return handler.json({'error': 'denied'}, status=401)
+
+        class Timing(Middleware):
+            @tulip.coroutine
+            def around(self, handler, call_next):
+                calls.append('enter')
+                response = yield from call_next(handler)
+                calls.append('exit')
+                return response
+
+        class Api(Application):
+            def get(self):
+                calls.append('get')
+                self.json({'user': self.request_args[0]})
+
+        router = Router(middleware=[Timing()])
+        router.add_handler(r'/user/(\d+)', Api(), middleware=[Auth()])
+
+        content = self._request(
+            router, b'GET /user/1 HTTP/1.1\r\nHost: example.com\r\n\r\n')
+        self.assertTrue(content.startswith(b'HTTP/1.1 401 '))
+        self.assertTrue(content.endswith(b'{"error":"denied"}'))
+        self.assertEqual(calls, ['enter', 'auth', 'exit'])
+
+        del calls[:]
+        content = self._request(
+            router,
+            b'GET /user/1?token=x HTTP/1.1\r\nHost: example.com\r\n\r\n')
+        self.assertTrue(content.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(content.endswith(b'{"user":"1"}'))
+        self.assertEqual(calls, ['enter', 'auth', 'get', 'exit'])
+
+    def test_router_middleware_added_later(self):
+        calls = []
+
+        class Trace(Middleware):
+            def before(self, handler):
+                calls.append('trace')
+
+        class Api(Application):
+            def get(self):
+                self.json({})
+
+        router = Router()
+        router.add_handler('/', Api())
+        router.middleware.append(Trace())
+        router.compile()
+        self._request(router, b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+        self.assertEqual(calls, ['trace'])
+
+    def test_blocking_handler(self):
+        import threading
+        threads = []
+
+        class Blocking(Application):
+            @blocking
+            def get(self):
+                threads.append(threading.current_thread())
+                self.response.write(b'from a thread')
+
+        router = Router()
+        router.add_handler('/', Blocking())
+        content = self._request(
+            router, b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+        self.assertIsNot(threads[0], threading.current_thread())
+        self.assertTrue(content.endswith(b'from a thread'))
+
+    def test_blocking_json(self):
+        class Api(Application):
+            @blocking
+            def get(self):
+                self.json({'created': True}, status=201)
+
+        router = Router()
+        router.add_handler('/', Api())
+        content = self._request(
+            router, b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+        headers, body = content.split(b'\r\n\r\n', 1)
+        self.assertTrue(headers.startswith(b'HTTP/1.1 201 '))
+        self.assertIn(b'CONTENT-TYPE: APPLICATION/JSON', headers.upper())
+        self.assertEqual(body, b'{"created":true}')
+
+    def test_offloaded_renders_in_order(self):
+        class Renderer(object):
+            def prepare(self, template_name):
+                def render(delay):
+                    time.sleep(delay)
+                    return template_name.encode('ascii')
+                return render
+
+        class Page(Application):
+            render_in_executor = True
+
+            def get(self):
+                # the first render finishes last
+                self.render('<first>', delay=0.05)
+                self.render('<second>', delay=0)
+                self.response.write(b'<trailer>')
+
+        page = Page()
+        page.renderer = Renderer()
+        router = Router()
+        router.add_handler('/', page)
+        content = self._request(
+            router, b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+        self.assertTrue(content.startswith(b'HTTP/1.1 200 '))
+        self.assertTrue(content.endswith(b'<first><second><trailer>'))
+
+    def test_handler_error(self):
+        class Forbidden(Application):
+            def get(self):
+                raise errors.HttpErrorException(403)
+
+        router = Router()
+        router.add_handler('/', Forbidden())
+        transport = unittest.mock.Mock()
+        srv = MockHttpServer(router)
+        srv.connection_made(transport)
+        self.assertIsInstance(srv.transport, CountingTransport)
+        srv.stream.feed_data(b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+        self.loop.run_until_complete(srv._request_handler)
+
+        content = b''.join([c[1][0] for c in transport.write.mock_calls])
+        self.assertTrue(content.startswith(b'HTTP/1.1 403 Forbidden\r\n'))
+
+    def test_blocking_handler_timeout(self):
+        import time
+
+        class Slow(Application):
+            @blocking(timeout=0.01)
+            def get(self):
+                time.sleep(0.1)
+
+        router = Router()
+        router.add_handler('/', Slow())
+        content = self._request(
+            router, b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+        self.assertTrue(content.startswith(b'HTTP/1.1 504 '))
+
+    def test_process_pool_disabled(self):
+        import threading
+        threads = []
+
+        class Offload(Application):
+            @tulip.coroutine
+            def get(self):
+                yield from self.run_blocking(
+                    lambda: threads.append(threading.current_thread()),
+                    process=True)
+                self.response.write(b'offloaded')
+
+        self.addCleanup(setattr, executor.processes, 'max_workers',
+                        executor.processes.max_workers)
+        executor.configure(max_processes=0)
+        router = Router()
+        router.add_handler('/', Offload())
+        content = self._request(
+            router, b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+        self.assertTrue(content.endswith(b'offloaded'))
+        # ran on the thread pool of this process
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_json_response(self):
+        class Api(Application):
+            def get(self):
+                self.json({'name': 'nacho', 'tags': [1, 2]}, status=201)
+
+        router = Router()
+        router.add_handler('/', Api())
+        transport = unittest.mock.Mock()
+        srv = MockHttpServer(router)
+        srv.connection_made(transport)
+        srv.stream.feed_data(b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+        self.loop.run_until_complete(srv._request_handler)
+
+        self.assertEqual(len(transport.write.mock_calls), 1)
+        content = transport.write.mock_calls[0][1][0]
+        headers, body = content.split(b'\r\n\r\n', 1)
+        self.assertTrue(headers.startswith(b'HTTP/1.1 201 '))
+        self.assertIn(b'CONTENT-TYPE: APPLICATION/JSON', headers.upper())
+        self.assertIn(b'CONTENT-LENGTH: 29', headers.upper())
+        self.assertNotIn(b'TRANSFER-ENCODING', headers.upper())
+        self.assertEqual(body, b'{"name":"nacho","tags":[1,2]}')
+
+    def test_json_response_started(self):
+        class Api(Application):
+            def get(self):
+                self.response.write(b'partial')
+                self.json({'name': 'nacho'})
+
+        router = Router()
+        router.add_handler('/', Api())
+        content = self._request(
+            router, b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+        self.assertTrue(content.startswith(b'HTTP/1.1 500 '))
+        self.assertEqual(content.count(b'HTTP/1.1 '), 1)
+        self.assertNotIn(b'nacho', content)
+
+    def test_json_response_compressed(self):
+        class Api(Application):
+            def get(self):
+                self.json(['nacho'] * 1000)
+
+        router = Router()
+        router.add_handler('/', Api())
+        content = self._request(
+            router, b'GET / HTTP/1.1\r\nAccept-Encoding: gzip\r\n'
+                    b'Host: example.com\r\n\r\n')
+        headers, body = content.split(b'\r\n\r\n', 1)
+        self.assertIn(b'CONTENT-ENCODING: GZIP', headers.upper())
+        self.assertIn('CONTENT-LENGTH: {}'.format(len(body)).encode(),
+                      headers.upper())
+        self.assertEqual(json.loads(gzip.decompress(body).decode()),
+                         ['nacho'] * 1000)
+
+    def test_cached_handler(self):
+        renders = []
+
+        class Page(Application):
+            response_cache = ResponseCache()
+
+            @cached(ttl=60)
+            def get(self):
+                renders.append(self)
+                self.response.write(b'page ' * 500)
+
+        router = Router()
+        router.add_handler('/', Page())
+        for path in (b'/?a=1&b=2', b'/?b=2&a=1'):
+            content = self._request(
+                router, b'GET ' + path + b' HTTP/1.1\r\n'
+                        b'Host: example.com\r\n\r\n')
+            headers, body = content.split(b'\r\n\r\n', 1)
+            self.assertIn(b'CONTENT-LENGTH: 2500', headers.upper())
+            self.assertEqual(body, b'page ' * 500)
+        self.assertEqual(len(renders), 1)
+
+        content = self._request(
+            router, b'GET / HTTP/1.1\r\nAccept-Encoding: gzip\r\n'
+                    b'Host: example.com\r\n\r\n')
+        headers, body = content.split(b'\r\n\r\n', 1)
+        self.assertIn(b'CONTENT-ENCODING: GZIP', headers.upper())
+        self.assertEqual(gzip.decompress(body), b'page ' * 500)
+        self.assertEqual(len(renders), 2)
+
+    def test_cached_handler_coalesces(self):
+        renders = []
+
+        class Slow(Application):
+            response_cache = ResponseCache()
+            cache_ttl = 60
+
+            @tulip.coroutine
+            def get(self):
+                renders.append(self)
+                yield from tulip.sleep(0.01)
+                self.response.write(b'slow')
+
+        router = Router()
+        router.add_handler('/', Slow())
+        transports, handlers = [], []
+        for _ in range(3):
+            transport = unittest.mock.Mock()
+            srv = MockHttpServer(router)
+            srv.connection_made(transport)
+            srv.stream.feed_data(
+                b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+            transports.append(transport)
+            handlers.append(srv._request_handler)
+        self.loop.run_until_complete(tulip.wait(handlers))
+        self.assertEqual(len(renders), 1)
+        for transport in transports:
+            content = b''.join(
+                [c[1][0] for c in list(transport.write.mock_calls)])
+            self.assertTrue(content.endswith(b'\r\n\r\nslow'))
+
+    def test_cached_handler_key(self):
+        shared = ResponseCache()
+
+        class Home(Application):
+            response_cache = shared
+            cache_ttl = 60
+
+            def get(self):
+                self.response.write(
+                    b'home of ' + self.get_header('Host').encode('ascii'))
+
+        class About(Home):
+            def get(self):
+                self.response.write(b'about')
+
+        home, about = Router(), Router()
+        home.add_handler('/', Home())
+        about.add_handler('/', About())
+        for router, host, expected in (
+                (home, b'a.example.com', b'home of a.example.com'),
+                (home, b'b.example.com', b'home of b.example.com'),
+                (about, b'a.example.com', b'about')):
+            content = self._request(
+                router, b'GET / HTTP/1.1\r\nHost: ' + host + b'\r\n\r\n')
+            headers, body = content.split(b'\r\n\r\n', 1)
+            self.assertEqual(body, expected)
+            # uncompressed, but one of the encodings of the url
+            self.assertIn(b'VARY: ACCEPT-ENCODING', headers.upper())
+        self.assertEqual(len(shared.entries), 3)
+
+    def test_response_cache_invalidate_shared(self):
+        shared = SharedCache(64 * 1024, slot_size=1024, ways=4)
+        shared.set('gzip:app.js', b'gzipped')
+        cache = ResponseCache(shared=shared)
+        entry = CachedResponse(200, [], b'body')
+        entry.expires = entry.stale_until = time.monotonic() + 60
+        cache.set(('a',), entry)
+        self.assertEqual(cache.get(('a',)).body, b'body')
+        cache.invalidate()
+        # only the responses, the other users of the cache keep theirs
+        self.assertIsNone(cache.get(('a',)))
+        self.assertEqual(shared.get('gzip:app.js'), b'gzipped')
+
+    def test_cached_handler_set_cookie(self):
+        renders = []
+
+        class Login(Application):
+            response_cache = ResponseCache()
+            cache_ttl = 60
+
+            @tulip.coroutine
+            def get(self):
+                renders.append(self)
+                yield from tulip.sleep(0.01)
+                self.response.add_header(
+                    'Set-Cookie', 'session={}'.format(len(renders)))
+                self.response.write(b'welcome')
+
+        router = Router()
+        router.add_handler('/', Login())
+        transports, handlers = [], []
+        for _ in range(2):
+            transport = unittest.mock.Mock()
+            srv = MockHttpServer(router)
+            srv.connection_made(transport)
+            srv.stream.feed_data(
+                b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+            transports.append(transport)
+            handlers.append(srv._request_handler)
+        self.loop.run_until_complete(tulip.wait(handlers))
+
+        # the waiting request rendered its own response
+        self.assertEqual(len(renders), 2)
+        self.assertEqual(len(Login.response_cache.entries), 0)
+        cookies = set()
+        for transport in transports:
+            content = b''.join(
+                [c[1][0] for c in list(transport.write.mock_calls)])
+            cookies.update(re.findall(br'session=\d', content))
+        self.assertEqual(cookies, {b'session=1', b'session=2'})
+
+    def test_static_file(self):
+        with tempfile.TemporaryDirectory() as root:
+            with open(os.path.join(root, 'app.js'), 'wb') as fp:
+                fp.write(b'x' * 100000)
+            router = Router()
+            router.add_handler('/static/(.*)', StaticFile(root))
+            content = self._request(
+                router, b'GET /static/app.js HTTP/1.1\r\n'
+                        b'Host: example.com\r\n\r\n')
+
+        headers, body = content.split(b'\r\n\r\n', 1)
+        self.assertTrue(headers.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertIn(b'CONTENT-LENGTH: 100000', headers.upper())
+        self.assertIn(b'CONTENT-TYPE: APPLICATION/JAVASCRIPT', headers.upper())
+        self.assertEqual(body, b'x' * 100000)
+
+    def test_static_file_outside_root(self):
+        with tempfile.TemporaryDirectory() as root:
+            router = Router()
+            router.add_handler('/static/(.*)', StaticFile(root))
+            content = self._request(
+                router, b'GET /static/../../etc/passwd HTTP/1.1\r\n'
+                        b'Host: example.com\r\n\r\n')
+        self.assertTrue(content.startswith(b'HTTP/1.1 404 Not Found\r\n'))
+
 
 class HttpServerProtocolTests(unittest.TestCase):
 
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+import sys
+import time
+import unittest
+import unittest.mock
+
+import tulip
+from nacho.metrics import Metrics, Watchdog, metrics, prometheus, \
+    request_context
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_encode_decode(self):
+        stats = Metrics()
+        stats.requests = 5
+        stats.in_flight = 2
+        stats.bytes_out = 1 << 40
+        stats.loop_lag = 0.25
+        stats.stalls = 3
+        stats.observe(0.003)
+        stats.observe(20)
+        decoded = Metrics.decode(stats.encode())
+        self.assertEqual(decoded.requests, 5)
+        self.assertEqual(decoded.in_flight, 2)
+        self.assertEqual(decoded.bytes_out, 1 << 40)
+        self.assertEqual(decoded.loop_lag, 0.25)
+        self.assertEqual(decoded.stalls, 3)
+        self.assertEqual(decoded.latency_buckets, stats.latency_buckets)
+        self.assertEqual(decoded.latency_buckets[0], 1)
+        self.assertEqual(decoded.latency_buckets[-1], 1)
+
+    def test_prometheus(self):
+        first, second, retired = Metrics(), Metrics(), Metrics()
+        first.requests, first.in_flight = 3, 1
+        second.requests = 4
+        retired.requests, retired.in_flight = 10, 7
+        first.observe(0.02)
+        second.observe(0.02)
+        text = prometheus({101: first, 102: second}, retired)
+        lines = text.splitlines()
+        self.assertIn('# TYPE nacho_requests_total counter', lines)
+        self.assertIn('nacho_requests_total 17', lines)
+        self.assertIn('nacho_requests_total{worker="101"} 3', lines)
+        self.assertIn('nacho_requests_in_flight 1', lines)
+        self.assertIn('nacho_workers 2', lines)
+        self.assertIn(
+            'nacho_request_duration_seconds_bucket{le="0.01"} 0', lines)
+        self.assertIn(
+            'nacho_request_duration_seconds_bucket{le="0.025"} 2', lines)
+        self.assertIn(
+            'nacho_request_duration_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn('nacho_request_duration_seconds_count 2', lines)
+
+
+class WatchdogTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = tulip.new_event_loop()
+        tulip.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_request_context(self):
+        class Server:
+            router = object()
+            message = unittest.mock.Mock(method='GET', path='/slow')
+
+            def handle(self, handler):
+                return handler.get()
+
+        class Handler:
+            def for_request(self):
+                pass
+
+            def get(self):
+                return request_context(sys._getframe())
+
+        self.assertEqual(Server().handle(Handler()),
+                         ('GET /slow', __name__ + '.Handler'))
+        self.assertEqual(request_context(sys._getframe()), (None, None))
+
+    def test_reports_blocked_loop(self):
+        reports = []
+        watchdog = Watchdog(self.loop, threshold=0.05)
+        watchdog.report = lambda frame, late: reports.append(late)
+        stalls = metrics.stalls
+        watchdog.start()
+        self.addCleanup(watchdog.join)
+        self.addCleanup(watchdog.stop)
+        self.loop.call_later(0.05, time.sleep, 0.3)
+        self.loop.run_until_complete(tulip.sleep(0.5))
+        self.assertEqual(len(reports), 1)
+        self.assertGreater(reports[0], 0.05)
+        self.assertEqual(metrics.stalls, stalls + 1)
+
+    def test_stop(self):
+        watchdog = Watchdog(self.loop, threshold=0.05)
+        watchdog.report = unittest.mock.Mock()
+        watchdog.start()
+        self.loop.run_until_complete(tulip.sleep(0.05))
+        watchdog.stop()
+        watchdog.join(1)
+        self.assertFalse(watchdog.is_alive())
+        # the loop is gone but no stall is reported
+        time.sleep(0.2)
+        self.assertFalse(watchdog.report.called)
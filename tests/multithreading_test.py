@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+import argparse
+import socket
+import unittest
+import unittest.mock
+
+import tulip
+from nacho import metrics, multithreading
+
+
+class BindSocketTest(unittest.TestCase):
+
+    def test_args(self):
+        args = multithreading.ARGS.parse_args([])
+        self.assertFalse(args.reuseport)
+        self.assertEqual(args.backlog, 1024)
+        args = multithreading.ARGS.parse_args(
+            ['--reuseport', '--backlog', '128'])
+        self.assertTrue(args.reuseport)
+        self.assertEqual(args.backlog, 128)
+
+    def test_shared_port_refused(self):
+        first = multithreading.bind_socket('127.0.0.1', 0, backlog=8)
+        self.addCleanup(first.close)
+        port = first.getsockname()[1]
+        self.assertRaises(OSError, multithreading.bind_socket,
+                          '127.0.0.1', port)
+
+    @unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'),
+                         'SO_REUSEPORT not supported')
+    def test_reuseport(self):
+        first = multithreading.bind_socket(
+            '127.0.0.1', 0, backlog=8, reuseport=True)
+        self.addCleanup(first.close)
+        port = first.getsockname()[1]
+        # every worker binds its own listening socket on the same port
+        second = multithreading.bind_socket(
+            '127.0.0.1', port, backlog=8, reuseport=True)
+        self.addCleanup(second.close)
+        self.assertEqual(second.getsockname()[1], port)
+        self.assertEqual(second.gettimeout(), 0.0)
+
+
+class ReplaceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = tulip.new_event_loop()
+        tulip.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _superviser(self, **args):
+        superviser = multithreading.Superviser.__new__(
+            multithreading.Superviser)
+        superviser.args = argparse.Namespace(graceful_timeout=0.01, **args)
+        superviser.workers = []
+        superviser.draining = []
+        return superviser
+
+    def test_unready_worker_killed(self):
+        superviser = self._superviser()
+        old = unittest.mock.Mock(retiring=False, pid=1)
+        new = unittest.mock.Mock(ready=tulip.Future(), pid=2)
+        superviser.workers.append(old)
+        superviser.spawn = lambda: new
+
+        replaced = self.loop.run_until_complete(superviser.replace(old))
+        self.assertFalse(replaced)
+        self.assertEqual(superviser.workers, [old])
+        self.assertTrue(new.kill.called)
+        self.assertFalse(old.retiring)
+
+    def test_ready_worker_replaces(self):
+        superviser = self._superviser()
+        old = unittest.mock.Mock(retiring=False, pid=1)
+        new = unittest.mock.Mock(ready=tulip.Future(), pid=2)
+        new.ready.set_result(2)
+        superviser.workers.append(old)
+        superviser.spawn = lambda: new
+
+        replaced = self.loop.run_until_complete(superviser.replace(old))
+        self.assertTrue(replaced)
+        self.assertEqual(superviser.workers, [new])
+        self.assertEqual(superviser.draining, [old])
+        old.drain.assert_called_with(0.01)
+
+    def test_collect_without_stats(self):
+        superviser = self._superviser()
+        superviser.retired = metrics.Metrics()
+        fresh = unittest.mock.Mock(stats=None, pid=1)
+        served = unittest.mock.Mock(stats=_stats(), pid=2)
+        served.stats.requests = 5
+        superviser.draining.extend([fresh, served])
+
+        # drained before its first stats frame
+        superviser.collect(fresh)
+        self.assertEqual(superviser.draining, [served])
+        self.assertEqual(superviser.retired.requests, 0)
+        superviser.collect(served)
+        self.assertEqual(superviser.draining, [])
+        self.assertEqual(superviser.retired.requests, 5)
+
+    def test_recycle_asks_until_drained(self):
+        child = multithreading.ChildProcess(
+            None, None, argparse.Namespace(
+                max_requests=1, max_requests_jitter=0, max_rss=0,
+                graceful_timeout=0.03), None, None, None)
+        self.addCleanup(setattr, metrics.metrics, 'requests',
+                        metrics.metrics.requests)
+        metrics.metrics.requests = 10
+        writer = unittest.mock.Mock()
+
+        task = child.recycle(writer, interval=0.005)
+        self.loop.run_until_complete(tulip.sleep(0.1))
+        # the replacement failed, the request is repeated
+        self.assertGreater(writer.send.call_count, 1)
+        child.draining = True
+        self.loop.run_until_complete(task)
+        calls = writer.send.call_count
+        self.loop.run_until_complete(tulip.sleep(0.05))
+        self.assertEqual(writer.send.call_count, calls)
+
+
+def _stats(in_flight=0, loop_lag=0.0):
+    stats = metrics.Metrics()
+    stats.in_flight = in_flight
+    stats.loop_lag = loop_lag
+    return stats
+
+
+class AutoscaleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.args = argparse.Namespace(
+            workers=2, max_workers=4, scale_interval=0.001,
+            scale_up_in_flight=8, scale_down_in_flight=1, scale_up_lag=0.1,
+            scale_up_after=3, scale_down_after=2)
+
+    def _run(self, samples, workers=2):
+        """Feed one stats sample per step, return the changes."""
+        changes, busy, idle = [], 0, 0
+        for stats in samples:
+            change, busy, idle = multithreading.scale_decision(
+                self.args, stats, workers, busy, idle)
+            workers += change
+            changes.append(change)
+        return changes
+
+    def test_scale_up(self):
+        busy = [_stats(in_flight=10), _stats(in_flight=8)]
+        self.assertEqual(self._run([busy] * 7), [0, 0, 1, 0, 0, 1, 0])
+
+    def test_scale_up_on_lag(self):
+        lagging = [_stats(in_flight=0, loop_lag=0.2)]
+        self.assertEqual(self._run([lagging] * 3), [0, 0, 1])
+
+    def test_scale_down(self):
+        idle = [_stats(in_flight=0)]
+        self.assertEqual(self._run([idle] * 4, workers=4), [0, -1, 0, -1])
+        # never below --workers
+        self.assertEqual(self._run([idle] * 4), [0, 0, 0, 0])
+
+    def test_no_flapping(self):
+        busy, idle = [_stats(in_flight=20)], [_stats(in_flight=0)]
+        middle = [_stats(in_flight=4)]
+        self.assertEqual(self._run([busy, busy, idle, busy, busy, middle,
+                                    idle, busy, idle] * 3, workers=3),
+                         [0] * 27)
+
+    def test_no_stats(self):
+        self.assertEqual(multithreading.scale_decision(
+            self.args, [], 2, 2, 0), (0, 2, 0))
+
+    def test_autoscale_spawns_and_retires(self):
+        loop = tulip.new_event_loop()
+        tulip.set_event_loop(loop)
+        self.addCleanup(loop.close)
+        superviser = multithreading.Superviser.__new__(
+            multithreading.Superviser)
+        superviser.args = self.args
+        superviser.workers = [_worker(_stats(in_flight=20))
+                              for _ in range(2)]
+        superviser.spawn = lambda: _worker(None)
+        superviser.retire = superviser.workers.remove
+
+        task = superviser.autoscale()
+        loop.run_until_complete(tulip.sleep(0.05))
+        self.assertEqual(len(superviser.workers), 4)
+        for worker in superviser.workers:
+            worker.stats = _stats(in_flight=0)
+        loop.run_until_complete(tulip.sleep(0.05))
+        self.assertEqual(len(superviser.workers), 2)
+        task.cancel()
+
+    def test_scale_down_during_replace(self):
+        loop = tulip.new_event_loop()
+        tulip.set_event_loop(loop)
+        self.addCleanup(loop.close)
+        superviser = multithreading.Superviser.__new__(
+            multithreading.Superviser)
+        superviser.args = self.args
+        superviser.workers = [_worker(_stats(in_flight=0)) for _ in range(3)]
+        # replace() retiring the first for a replacement not ready yet
+        superviser.workers[0].retiring = True
+        starting = _worker(None, ready=False)
+        superviser.workers.append(starting)
+        retired = []
+        superviser.retire = lambda worker: (
+            retired.append(worker), superviser.workers.remove(worker))
+
+        task = superviser.autoscale()
+        loop.run_until_complete(tulip.sleep(0.05))
+        task.cancel()
+        self.assertEqual(len(retired), 1)
+        self.assertNotIn(starting, retired)
+        self.assertTrue(superviser.workers[0].retiring)
+        # once replace() retires the first, --workers are left
+        self.assertEqual(superviser.workers[1:], [
+            worker for worker in superviser.workers if not worker.retiring])
+        self.assertEqual(len(superviser.workers) - 1, self.args.workers)
+
+
+def _worker(stats, ready=True):
+    worker = unittest.mock.Mock(stats=stats, retiring=False)
+    worker.ready = tulip.Future()
+    if ready:
+        worker.ready.set_result(None)
+    return worker
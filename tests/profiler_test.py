@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+from nacho.profiler import Profiler, collapse, walk_stack
+
+
+class Server:
+    router = object()
+    route = '/slow$'
+    profiled = True
+
+    def handle(self, handler):
+        return handler.get()
+
+
+class Handler:
+    def for_request(self):
+        pass
+
+    def get(self):
+        return collapse(sys._getframe())
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def test_collapse(self):
+        stack = collapse_from(Server())
+        self.assertEqual(stack.split(';'), [
+            '/slow$', __name__ + '.Handler',
+            'profiler_test.py:handle', 'profiler_test.py:get'])
+
+    def test_walk_stack(self):
+        class Walker(Handler):
+            def get(self):
+                return list(walk_stack(sys._getframe()))
+
+        walked = Server().handle(Walker())
+        frame, obj, handler = walked[0]
+        self.assertEqual(frame.f_code.co_name, 'get')
+        self.assertIsInstance(obj, Walker)
+        self.assertEqual(handler, __name__ + '.Walker')
+        # the handler found stays set for the frames further out
+        self.assertIsInstance(walked[1][1], Server)
+        self.assertEqual(walked[-1][2], __name__ + '.Walker')
+
+    def test_collapse_not_profiled(self):
+        server = Server()
+        server.profiled = False
+        self.assertIsNone(collapse_from(server))
+
+    def test_samples_profiled_requests(self):
+        directory = tempfile.mkdtemp()
+        profiler = Profiler(rate=1, interval=0.001, directory=directory)
+        self.assertTrue(profiler.sample())
+        profiler.start()
+
+        class Busy(Handler):
+            def get(self):
+                deadline = time.monotonic() + 0.1
+                while time.monotonic() < deadline:
+                    pass
+
+        profiler.active += 1
+        Server().handle(Busy())
+        profiler.active -= 1
+
+        path = profiler.dump()
+        self.assertEqual(path, os.path.join(
+            directory, 'nacho-{}.folded'.format(os.getpid())))
+        with open(path) as fp:
+            lines = fp.read().splitlines()
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertTrue(stack.startswith('/slow$;' + __name__ + '.Busy;'))
+        self.assertTrue(stack.endswith('profiler_test.py:get'))
+        self.assertGreater(int(count), 0)
+
+
+def collapse_from(server):
+    return server.handle(Handler())
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from nacho import http
+from nacho.app import Application
+from nacho.renderers import jinja2, quik
+
+
+class RendererCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self._write('hello.html', 'Hello {{ name }}!')
+        self._write('hello.quik', 'Hello @name!')
+
+    def tearDown(self):
+        jinja2._environments.clear()
+        quik._loaders.clear()
+        shutil.rmtree(self.root)
+
+    def _write(self, name, content):
+        with open(os.path.join(self.root, name), 'w') as fp:
+            fp.write(content)
+
+    def test_jinja2_environment_reused(self):
+        first = jinja2.Jinja2Worker([self.root])
+        second = jinja2.Jinja2Worker([self.root])
+        self.assertIs(first.env, second.env)
+        self.assertIsNot(
+            first.env, jinja2.Jinja2Worker([self.root], auto_reload=True).env)
+
+    def test_jinja2_invalidate(self):
+        worker = jinja2.Jinja2Worker([self.root])
+        self.assertEqual(worker.render('hello.html', name='nacho'),
+                         b'Hello nacho!')
+        self._write('hello.html', 'Bye {{ name }}!')
+        # compiled once, kept until invalidated
+        self.assertEqual(worker.render('hello.html', name='nacho'),
+                         b'Hello nacho!')
+        worker.invalidate('hello.html')
+        self.assertEqual(worker.render('hello.html', name='nacho'),
+                         b'Bye nacho!')
+
+    def test_quik_loader_reused(self):
+        first = quik.QuikWorker([self.root])
+        second = quik.QuikWorker([self.root])
+        self.assertIs(first._get_loader(), second._get_loader())
+        self.assertIsNot(
+            first._get_loader(),
+            quik.QuikWorker([self.root], auto_reload=True)._get_loader())
+
+    def test_quik_invalidate(self):
+        worker = quik.QuikWorker([self.root])
+        template, _ = worker.get_template('hello.quik')
+        self.assertIs(worker.get_template('hello.quik')[0], template)
+        worker.invalidate('hello.quik')
+        self.assertIsNot(worker.get_template('hello.quik')[0], template)
+
+
+class StreamTemplatesTest(unittest.TestCase):
+
+    def test_jinja2_stream_fragments(self):
+        root = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(root, 'list.html'), 'w') as fp:
+                fp.write('<ul>{% for i in items %}<li>{{ i }}</li>'
+                         '{% endfor %}</ul>')
+            fragments = []
+            jinja2.Jinja2Worker([root]).stream(
+                'list.html', fragments.append, items=[1, 2, 3])
+        finally:
+            jinja2._environments.clear()
+            shutil.rmtree(root)
+        self.assertGreater(len(fragments), 1)
+        self.assertEqual(b''.join(fragments),
+                         b'<ul><li>1</li><li>2</li><li>3</li></ul>')
+
+    def test_fragments_written_while_rendering(self):
+        flushed = []
+
+        class Renderer(object):
+            def stream(self, template_name, write, **kwargs):
+                for fragment in (b'<ul>', b'<li>1</li>', b'<li>2</li>',
+                                 b'</ul>'):
+                    write(fragment)
+                    flushed.append(len(handler.response.write.mock_calls))
+
+        class Page(Application):
+            stream_templates = True
+            stream_chunk_size = 8
+
+        handler = Page(write_headers=False)
+        handler.renderer = Renderer()
+        handler.response = unittest.mock.Mock()
+        handler.render('list.html')
+
+        # fragments go out once stream_chunk_size bytes are buffered, not
+        # when the whole template is rendered
+        self.assertEqual(flushed, [0, 1, 2, 2])
+        writes = [c[1][0] for c in handler.response.write.mock_calls]
+        self.assertEqual(writes, [b'<ul><li>1</li>', b'<li>2</li>',
+                                  b'</ul>'])
+
+    def test_fragments_sent_while_rendering(self):
+        sent = []
+
+        class Renderer(object):
+            def stream(self, template_name, write, **kwargs):
+                for fragment in (b'<ul>', b'<li>1</li>', b'<li>2</li>',
+                                 b'</ul>'):
+                    write(fragment)
+                    sent.append(len(transport.write.mock_calls))
+
+        class Page(Application):
+            stream_templates = True
+            stream_chunk_size = 8
+
+        transport = unittest.mock.Mock()
+        handler = Page(write_headers=False)
+        handler.renderer = Renderer()
+        # the chunk size a large socket send buffer gives
+        handler.response = http.Response(
+            transport, 200, min_size=1024, chunk_size=256 * 1024)
+        handler.render('list.html')
+
+        # each batch reaches the transport, not only a full chunk
+        self.assertEqual(sent, [0, 1, 2, 2])
+        handler.response.write_eof()
+        content = b''.join(c[1][0] for c in transport.write.mock_calls)
+        self.assertIn(b'<ul><li>1</li>', content)
+        self.assertTrue(content.endswith(b'0\r\n\r\n'))
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+import unittest
+import unittest.mock
+
+import tulip
+from tulip.http.errors import HttpErrorException
+from nacho.http import FlowControlledPayload
+from nacho.request import MultiDict, Request, UploadedFile
+
+
+class Payload:
+
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+
+    @tulip.coroutine
+    def read(self):
+        return self.chunks.pop(0) if self.chunks else None
+
+
+def request(path='/', headers=(), body=()):
+    message = unittest.mock.Mock(method='POST', path=path, version=(1, 1),
+                                 headers=list(headers))
+    return Request(message, Payload(*body))
+
+
+class RequestTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = tulip.new_event_loop()
+        tulip.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_multidict(self):
+        d = MultiDict([('a', '1'), ('b', '2'), ('a', '3')])
+        self.assertEqual(d['a'], '1')
+        self.assertEqual(d.getall('a'), ['1', '3'])
+        self.assertEqual(d.getall('c'), [])
+        self.assertEqual(len(d), 2)
+        self.assertEqual(d.items(), [('a', '1'), ('b', '2'), ('a', '3')])
+        with self.assertRaises(TypeError):
+            d['a'] = '4'
+
+    def test_query(self):
+        req = request('/search?q=nacho&tag=a&tag=b&empty=')
+        self.assertNotIn('args', req.__dict__)
+        self.assertEqual(req.args.getall('tag'), ['a', 'b'])
+        self.assertEqual(req.args['empty'], '')
+        self.assertEqual(req.query, {'q': 'nacho', 'tag': ['a', 'b']})
+        self.assertIs(req.args, req.args)
+
+    def test_too_many_fields(self):
+        req = request('/?' + '&'.join('a=1' for _ in range(2000)))
+        with self.assertRaises(HttpErrorException) as cm:
+            req.args
+        self.assertEqual(cm.exception.code, 400)
+
+    def test_headers_and_cookies(self):
+        req = request(headers=[('HOST', 'example.com'),
+                               ('COOKIE', 'session=abc; theme=dark')])
+        self.assertEqual(req.headers['host'], 'example.com')
+        self.assertEqual(req.cookies['session'], 'abc')
+        self.assertEqual(req.cookies['theme'], 'dark')
+
+    def test_urlencoded_form(self):
+        req = request(headers=[
+            ('CONTENT-TYPE', 'application/x-www-form-urlencoded')],
+            body=[b'name=nacho&', b'lang=py'])
+        form = self.loop.run_until_complete(req.form())
+        self.assertEqual(form['name'], 'nacho')
+        self.assertEqual(form['lang'], 'py')
+        self.assertIs(self.loop.run_until_complete(req.form()), form)
+
+    def test_json(self):
+        req = request(body=[b'{"a": ', b'[1, 2]}'])
+        self.assertEqual(self.loop.run_until_complete(req.json()),
+                         {'a': [1, 2]})
+
+    def test_body_too_large(self):
+        req = request(headers=[('CONTENT-LENGTH', str(20 * 1024 * 1024))])
+        with self.assertRaises(HttpErrorException) as cm:
+            self.loop.run_until_complete(req.body())
+        self.assertEqual(cm.exception.code, 413)
+
+        req = request(body=[b'x' * 1024] * 2)
+        req.max_body_size = 1500
+        with self.assertRaises(HttpErrorException) as cm:
+            self.loop.run_until_complete(req.body())
+        self.assertEqual(cm.exception.code, 413)
+
+    def test_multipart_form(self):
+        body = (b'--XyZ\r\n'
+                b'Content-Disposition: form-data; name="title"\r\n\r\n'
+                b'Hello\r\n'
+                b'--XyZ\r\n'
+                b'Content-Disposition: form-data; name="upload"; '
+                b'filename="a.txt"\r\n'
+                b'Content-Type: text/plain\r\n\r\n' +
+                b'x' * 5000 + b'\r\n--XyZ--\r\n')
+        # split at every few bytes to cross delimiters between chunks
+        chunks = [body[i:i + 7] for i in range(0, len(body), 7)]
+        req = request(headers=[
+            ('CONTENT-TYPE', 'multipart/form-data; boundary=XyZ')],
+            body=chunks)
+        req.max_memory = 1024
+        form = self.loop.run_until_complete(req.form())
+        self.assertEqual(form['title'], 'Hello')
+        upload = form['upload']
+        self.assertIsInstance(upload, UploadedFile)
+        self.assertEqual(upload.filename, 'a.txt')
+        self.assertEqual(upload.content_type, 'text/plain')
+        self.assertEqual(upload.size, 5000)
+        self.assertEqual(upload.file.read(), b'x' * 5000)
+
+    def test_truncated_multipart(self):
+        req = request(headers=[
+            ('CONTENT-TYPE', 'multipart/form-data; boundary=XyZ')],
+            body=[b'--XyZ\r\nContent-Disposition: form-data; name="a"\r\n'])
+        with self.assertRaises(HttpErrorException) as cm:
+            self.loop.run_until_complete(req.form())
+        self.assertEqual(cm.exception.code, 400)
+
+    def test_pipe(self):
+        written = []
+
+        @tulip.coroutine
+        def write(chunk):
+            written.append(chunk)
+
+        req = request(body=[b'abc', b'def'])
+        size = self.loop.run_until_complete(req.pipe(write))
+        self.assertEqual(size, 6)
+        self.assertEqual(written, [b'abc', b'def'])
+
+    def test_save(self):
+        import tempfile
+        with tempfile.NamedTemporaryFile() as fp:
+            req = request(body=[b'x' * 1000, b'y' * 1000])
+            self.loop.run_until_complete(req.save(fp.name))
+            self.assertEqual(fp.read(), b'x' * 1000 + b'y' * 1000)
+
+
+class FlowControlTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = tulip.new_event_loop()
+        tulip.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_pause_and_resume(self):
+        transport = unittest.mock.Mock()
+        payload = tulip.DataBuffer()
+        flow = FlowControlledPayload(transport, payload, high_water=100)
+        payload.feed_data(b'x' * 60)
+        self.assertFalse(transport.pause.called)
+        payload.feed_data(b'x' * 60)
+        self.assertTrue(transport.pause.called)
+        self.loop.run_until_complete(flow.read())
+        self.assertFalse(transport.resume.called)
+        self.loop.run_until_complete(flow.read())
+        self.assertTrue(transport.resume.called)
+        self.assertEqual(flow.buffered, 0)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+import re
+import unittest
+
+from nacho.routing import Router
+
+
+class RouterTest(unittest.TestCase):
+
+    def _linear(self, routes, url):
+        for regex, handler in routes:
+            match = re.match(regex, url)
+            if match:
+                return [handler], match.groups()
+        return None, None
+
+    def test_literal_prefix(self):
+        router = Router()
+        router.add_handler('/static/', ['static'])
+        self.assertEqual(router.get_handler('/static/app.js'),
+                         (['static'], ()))
+        self.assertEqual(router.get_handler('/stat'), (None, None))
+
+    def test_pattern_groups(self):
+        router = Router()
+        router.add_handler(r'/user/(\d+)/(\w+)$', ['user'])
+        router.add_handler('/(.*)', ['home'])
+        self.assertEqual(router.get_handler('/user/12/edit'),
+                         (['user'], ('12', 'edit')))
+        self.assertEqual(router.get_handler('/about'), (['home'], ('about',)))
+
+    def test_get_route(self):
+        router = Router()
+        router.add_handler(r'/user/(\d+)$', ['user'])
+        router.add_handler('/(.*)', ['home'])
+        self.assertEqual(router.get_route('/user/12'), r'/user/(\d+)$')
+        self.assertEqual(router.get_route('/about'), '/(.*)')
+        self.assertIsNone(router.get_route('about'))
+
+    def test_first_match_wins(self):
+        router = Router()
+        router.add_handler('/(.*)', ['catchall'])
+        router.add_handler('/static/', ['static'])
+        self.assertEqual(router.get_handler('/static/x'),
+                         (['catchall'], ('static/x',)))
+
+    def test_handlers_list(self):
+        router = Router()
+        router.add_handler('/', ['first', 'second'])
+        self.assertEqual(router.get_handler('/')[0], ['first', 'second'])
+
+    def test_same_as_linear_scan(self):
+        routes = [
+            ('/static/', 'static'),
+            (r'/api/(?P<version>v\d)/', 'api'),
+            (r'/api/(?P<version>v\d)/users', 'users'),
+            (r'/blog/(\d{4})/(\d{2})/', 'archive'),
+            ('/blog/', 'blog'),
+            (r'/(a)\1', 'backref'),
+            ('/b', 'b'),
+            ('/c|/d', 'alternation'),
+            ('/ef?g', 'optional'),
+            ('/(.*)', 'home'),
+        ]
+        router = Router()
+        for regex, handler in routes:
+            router.add_handler(regex, [handler])
+        for url in ('/static/a.css', '/api/v1/', '/api/v1/users',
+                    '/blog/2013/05/', '/blog/', '/aa', '/b', '/ab', '/d', '/eg', '/efg',
+                    '/'):
+            self.assertEqual(router.get_handler(url),
+                             self._linear(routes, url), url)
+
+    def test_cache_invalidated_on_add(self):
+        router = Router(cache_size=2)
+        router.add_handler('/a', ['a'])
+        self.assertEqual(router.get_handler('/b'), (None, None))
+        router.add_handler('/b', ['b'])
+        self.assertEqual(router.get_handler('/b'), (['b'], ()))
+        router.get_handler('/c')
+        router.get_handler('/d')
+        self.assertEqual(len(router.cache), 2)
@@ -1,6 +1,15 @@
 #!/usr/bin/env python
 import unittest
 from http_server_test import *
+from routing_test import *
+from static_test import *
+from compression_test import *
+from metrics_test import *
+from multithreading_test import *
+from profiler_test import *
+from request_test import *
+from shm_test import *
+from renderers_test import *
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+import os
+import time
+import unittest
+
+from nacho.shm import SharedCache
+
+
+class SharedCacheTest(unittest.TestCase):
+
+    def test_set_get(self):
+        cache = SharedCache(64 * 1024, slot_size=1024, ways=4)
+        self.assertTrue(cache.set('a', b'first'))
+        self.assertTrue(cache.set(b'b', b''))
+        self.assertEqual(cache.get('a'), b'first')
+        self.assertEqual(cache.get('b'), b'')
+        self.assertIsNone(cache.get('c'))
+        self.assertTrue(cache.set('a', b'second'))
+        self.assertEqual(cache.get('a'), b'second')
+        self.assertEqual(len(cache), 2)
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_too_large(self):
+        cache = SharedCache(64 * 1024, slot_size=1024, ways=4)
+        self.assertFalse(cache.set('big', b'x' * 1024))
+        self.assertIsNone(cache.get('big'))
+
+    def test_ttl(self):
+        cache = SharedCache(64 * 1024, slot_size=1024, ways=4)
+        cache.set('short', b'x', ttl=0.01)
+        cache.set('long', b'y', ttl=60)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('short'))
+        self.assertEqual(cache.get('long'), b'y')
+
+    def test_lru_within_set(self):
+        cache = SharedCache(4 * 1024, slot_size=1024, ways=4)
+        self.assertEqual(cache.sets, 1)
+        for key in 'abcd':
+            cache.set(key, key.encode())
+        cache.get('a')
+        cache.set('e', b'e')
+        self.assertEqual(cache.get('a'), b'a')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('e'), b'e')
+
+    def test_shared_across_fork(self):
+        cache = SharedCache(64 * 1024, slot_size=1024, ways=4)
+        pid = os.fork()
+        if not pid:
+            try:
+                cache.set('child', str(os.getpid()).encode())
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(cache.get('child'), str(pid).encode())
+
+    def test_lock_timeout(self):
+        cache = SharedCache(4 * 1024, slot_size=1024, ways=4,
+                            lock_timeout=0.01)
+        cache.set('a', b'a')
+        lock = cache.locks[0]
+        lock.acquire()
+        try:
+            # a stuck holder makes reads miss and writes skip
+            self.assertIsNone(cache.get('a'))
+            self.assertFalse(cache.set('b', b'b'))
+            cache.delete('a')
+            cache.clear()
+        finally:
+            lock.release()
+        self.assertEqual(cache.get('a'), b'a')
+        self.assertIsNone(cache.get('b'))
+
+    def test_clear_prefix(self):
+        cache = SharedCache(64 * 1024, slot_size=1024, ways=4)
+        cache.set('jinja2:index', b'code')
+        cache.set(b'response:\x80', b'page')
+        cache.set('gzip', b'short key')
+        cache.clear('response:')
+        self.assertIsNone(cache.get(b'response:\x80'))
+        self.assertEqual(cache.get('jinja2:index'), b'code')
+        self.assertEqual(cache.get('gzip'), b'short key')
+        cache.clear(b'jinja2:')
+        self.assertEqual(len(cache), 1)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+import gzip
+import os
+import re
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import tulip
+from nacho import static
+from nacho.app import StaticFile
+from nacho.routing import Router
+
+from http_server_test import MockHttpServer
+
+
+class StaticFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = tulip.new_event_loop()
+        tulip.set_event_loop(self.loop)
+        self.root = tempfile.mkdtemp()
+        self.body = bytes(range(256)) * 40
+        with open(os.path.join(self.root, 'data.bin'), 'wb') as fp:
+            fp.write(self.body)
+        self.router = Router()
+        self.router.add_handler('/static/(.*)', StaticFile(self.root))
+
+    def tearDown(self):
+        static.file_cache.clear()
+        static.compressed_cache.clear()
+        shutil.rmtree(self.root)
+        self.loop.close()
+
+    def _get(self, *headers, method=b'GET', path=b'/static/data.bin'):
+        transport = unittest.mock.Mock()
+        srv = MockHttpServer(self.router)
+        srv.connection_made(transport)
+        srv.stream.feed_data(
+            method + b' ' + path + b' HTTP/1.1\r\n'
+            b'Host: example.com\r\n' +
+            b''.join(header + b'\r\n' for header in headers) + b'\r\n')
+        self.loop.run_until_complete(srv._request_handler)
+
+        content = b''.join([c[1][0] for c in list(transport.write.mock_calls)])
+        head, body = content.split(b'\r\n\r\n', 1)
+        lines = head.decode('ascii').split('\r\n')
+        code = int(re.match(r'^HTTP/1.1 (\d+) ', lines[0]).groups()[0])
+        headers = dict((name.upper(), value) for name, value in
+                       (line.split(': ', 1) for line in lines[1:]))
+        return code, headers, body
+
+    def test_validators(self):
+        code, headers, body = self._get()
+        self.assertEqual(code, 200)
+        self.assertEqual(headers['ACCEPT-RANGES'], 'bytes')
+        self.assertIn('ETAG', headers)
+        self.assertIn('LAST-MODIFIED', headers)
+        self.assertEqual(body, self.body)
+
+    def test_if_none_match(self):
+        etag = self._get()[1]['ETAG'].encode('ascii')
+        code, headers, body = self._get(b'If-None-Match: "x", ' + etag)
+        self.assertEqual(code, 304)
+        self.assertEqual(headers['ETAG'], etag.decode('ascii'))
+        self.assertEqual(body, b'')
+
+        code, _, body = self._get(b'If-None-Match: "other"')
+        self.assertEqual(code, 200)
+        self.assertEqual(body, self.body)
+
+    def test_if_modified_since(self):
+        modified = self._get()[1]['LAST-MODIFIED'].encode('ascii')
+        code, _, body = self._get(b'If-Modified-Since: ' + modified)
+        self.assertEqual(code, 304)
+        self.assertEqual(body, b'')
+
+        code, _, _ = self._get(
+            b'If-Modified-Since: Thu, 01 Jan 1970 00:00:00 GMT')
+        self.assertEqual(code, 200)
+
+    def test_single_range(self):
+        code, headers, body = self._get(b'Range: bytes=10-19')
+        self.assertEqual(code, 206)
+        self.assertEqual(headers['CONTENT-RANGE'],
+                         'bytes 10-19/{}'.format(len(self.body)))
+        self.assertEqual(headers['CONTENT-LENGTH'], '10')
+        self.assertEqual(body, self.body[10:20])
+
+    def test_suffix_range(self):
+        code, _, body = self._get(b'Range: bytes=-5')
+        self.assertEqual(code, 206)
+        self.assertEqual(body, self.body[-5:])
+
+    def test_multi_range(self):
+        code, headers, body = self._get(b'Range: bytes=0-1,100-')
+        self.assertEqual(code, 206)
+        content_type = headers['CONTENT-TYPE']
+        self.assertTrue(content_type.startswith('multipart/byteranges'))
+        boundary = content_type.split('boundary=')[1].encode('ascii')
+        self.assertEqual(int(headers['CONTENT-LENGTH']), len(body))
+        parts = body.split(b'--' + boundary)
+        self.assertEqual(len(parts), 4)
+        self.assertTrue(parts[1].endswith(b'\r\n\r\n' + self.body[:2] +
+                                          b'\r\n'))
+        self.assertIn(b'Content-Range: bytes 100-', parts[2])
+        self.assertTrue(parts[2].endswith(self.body[100:] + b'\r\n'))
+        self.assertEqual(parts[3], b'--\r\n')
+
+    def test_unsatisfiable_range(self):
+        code, headers, _ = self._get(b'Range: bytes=999999-')
+        self.assertEqual(code, 416)
+        self.assertEqual(headers['CONTENT-RANGE'],
+                         'bytes */{}'.format(len(self.body)))
+
+    def test_if_range_mismatch(self):
+        code, _, body = self._get(b'Range: bytes=0-9',
+                                  b'If-Range: "stale"')
+        self.assertEqual(code, 200)
+        self.assertEqual(body, self.body)
+
+    def test_gzip_sibling(self):
+        with open(os.path.join(self.root, 'data.bin.gz'), 'wb') as fp:
+            fp.write(b'precompressed')
+        code, headers, body = self._get(b'Accept-Encoding: gzip, deflate')
+        self.assertEqual(code, 200)
+        self.assertEqual(headers['CONTENT-ENCODING'], 'gzip')
+        self.assertEqual(headers['VARY'], 'Accept-Encoding')
+        self.assertEqual(body, b'precompressed')
+
+        code, headers, body = self._get(b'Accept-Encoding: gzip;q=0')
+        self.assertNotIn('CONTENT-ENCODING', headers)
+        self.assertEqual(body, self.body)
+
+    def test_compressed_cache(self):
+        with open(os.path.join(self.root, 'app.js'), 'wb') as fp:
+            fp.write(b'var nacho = 1;\n' * 200)
+        code, headers, body = self._get(b'Accept-Encoding: gzip',
+                                        path=b'/static/app.js')
+        self.assertEqual(code, 200)
+        self.assertEqual(headers['CONTENT-ENCODING'], 'gzip')
+        self.assertEqual(int(headers['CONTENT-LENGTH']), len(body))
+        self.assertEqual(gzip.decompress(body), b'var nacho = 1;\n' * 200)
+        self.assertEqual(len(static.compressed_cache.entries), 1)
+
+        code, _, _ = self._get(b'Accept-Encoding: gzip',
+                               b'If-None-Match: ' +
+                               headers['ETAG'].encode('ascii'),
+                               path=b'/static/app.js')
+        self.assertEqual(code, 304)
+
+    def test_gzip_file_by_name(self):
+        with open(os.path.join(self.root, 'app.js.gz'), 'wb') as fp:
+            fp.write(gzip.compress(b'var nacho = 1;\n'))
+        code, headers, body = self._get(b'Accept-Encoding: gzip',
+                                        path=b'/static/app.js.gz')
+        self.assertEqual(code, 200)
+        self.assertEqual(headers['CONTENT-TYPE'], 'application/gzip')
+        self.assertNotIn('CONTENT-ENCODING', headers)
+        self.assertEqual(gzip.decompress(body), b'var nacho = 1;\n')
+
+    def test_head(self):
+        code, headers, body = self._get(method=b'HEAD')
+        self.assertEqual(code, 200)
+        self.assertEqual(headers['CONTENT-LENGTH'], str(len(self.body)))
+        self.assertEqual(body, b'')
+
+    def test_query_string_ignored(self):
+        code, _, body = self._get(path=b'/static/data.bin?v=3')
+        self.assertEqual(code, 200)
+        self.assertEqual(body, self.body)
+
+    def test_percent_encoded_name(self):
+        with open(os.path.join(self.root, 'my file.txt'), 'wb') as fp:
+            fp.write(b'spaced')
+        code, _, body = self._get(path=b'/static/my%20file.txt')
+        self.assertEqual(code, 200)
+        self.assertEqual(body, b'spaced')
+
+        code, _, _ = self._get(path=b'/static/%2e%2e/%2e%2e/etc/passwd')
+        self.assertEqual(code, 404)
+
+
+class ParseRangeTest(unittest.TestCase):
+
+    def test_parse_range(self):
+        self.assertEqual(static.parse_range('bytes=0-9', 100), [(0, 9)])
+        self.assertEqual(static.parse_range('bytes=90-', 100), [(90, 99)])
+        self.assertEqual(static.parse_range('bytes=-10', 100), [(90, 99)])
+        self.assertEqual(static.parse_range('bytes=0-999', 100), [(0, 99)])
+        self.assertEqual(static.parse_range('bytes=0-0, 5-6', 100),
+                         [(0, 0), (5, 6)])
+
+    def test_parse_range_unsatisfiable(self):
+        self.assertEqual(static.parse_range('bytes=100-', 100), [])
+        self.assertEqual(static.parse_range('bytes=-0', 100), [])
+
+    def test_parse_range_ignored(self):
+        self.assertIsNone(static.parse_range('items=0-9', 100))
+        self.assertIsNone(static.parse_range('bytes=9-0', 100))
+        self.assertIsNone(static.parse_range('bytes=a-b', 100))
+        self.assertIsNone(static.parse_range(
+            'bytes=' + ','.join(['0-0'] * 17), 100))
+
+
+class PrecompressTest(unittest.TestCase):
+
+    def test_precompress(self):
+        root = tempfile.mkdtemp()
+        try:
+            for name, data in (('app.css', b'body {}\n' * 100),
+                               ('tiny.js', b'1'),
+                               ('image.png', b'\x89PNG' * 100)):
+                with open(os.path.join(root, name), 'wb') as fp:
+                    fp.write(data)
+            written = list(static.precompress(root))
+            self.assertEqual([os.path.basename(path)
+                              for path, _, _ in written], ['app.css'])
+            with open(os.path.join(root, 'app.css.gz'), 'rb') as fp:
+                self.assertEqual(gzip.decompress(fp.read()),
+                                 b'body {}\n' * 100)
+            # up to date siblings are kept
+            self.assertEqual(list(static.precompress(root)), [])
+        finally:
+            shutil.rmtree(root)